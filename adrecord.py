@@ -0,0 +1,89 @@
+"""
+module with the record type of a scraped ad for Real Estate scraper.
+An ad goes from the parser (realestatescraper.parse_ad_page()) through the agent stage to the database writer
+(updatedb.feed_ads()), and up to config.DEFAULT_SCRAPEDICSIZE ads wait in memory for a flush.
+AdRecord keeps them in __slots__ instead of a dictionary of ~35 keys, with the values already converted to the
+types of the database columns (int price, float rooms...), so that they are converted once, when the page is parsed,
+and the boolean features (config.BOOLEAN_FEATURES) are packed into a single integer bitmask.
+This module defines functions to be used by the other modules, thus there is no main() function.
+"""
+
+import config
+
+
+# bit of each boolean feature in AdRecord.features, in config.BOOLEAN_FEATURES order
+FEATURE_BITS = {feature: 1 << i for i, feature in enumerate(config.BOOLEAN_FEATURES)}
+# {bitmask: tuple of the feature values}, filled on demand (at most 2 ** len(config.BOOLEAN_FEATURES) entries)
+FEATURE_VALUES = {}
+
+# fields of an ad, as returned by AdRecord.as_dict() (with the boolean features)
+FIELDS = ['ad_id', 'property_type', 'ad_type', 'date', 'address', 'neighborhood', 'city', 'price', 'rooms',
+          'floor_property', 'size_m2', 'entry_date', 'description', 'floors_total', 'condo_fee', 'arnona',
+          'contact_type', 'contact_office', 'contact_website_id', 'contact_name', 'contact_phone', 'listing_hash']
+
+
+def to_str(value):
+    """
+    plain str of a tag's string, None if the tag has no string (None or nested markup).
+    bs4's NavigableString keeps a reference to its whole page: a record holding one would keep the page alive
+    while it waits in the writer buffer, and could not be pickled back from a parse worker.
+    """
+    return str(value) if value is not None else None
+
+
+def to_int(value):
+    """ int of a string of digits, None if the string is empty or None """
+    return int(value) if value else None
+
+
+def to_float(value):
+    """ float of a numeric string, None if the string is empty or None """
+    return float(value) if value else None
+
+
+class AdRecord:
+    """
+    details of a scraped ad, with the types of the database columns:
+    ad_id (str, as in urls), website_id (int), price, size_m2, condo_fee, arnona, contact_website_id (int or None),
+    rooms (float or None), features (bitmask of config.BOOLEAN_FEATURES, see set_feature()), the others str or None.
+    Values are plain Python objects, never bs4 objects (see to_str()).
+    """
+
+    __slots__ = FIELDS + ['website_id', 'features']
+
+    def __init__(self, ad_id, property_type, ad_type, date):
+        """
+        :param ad_id: ad id (str)
+        :param property_type: property_type of current search. See config.PROPERTY_TYPES
+        :param ad_type: ad_type of current search. See config.AD_TYPES
+        :param date: date of the crawl in iso format
+        """
+        self.ad_id = ad_id
+        self.website_id = int(ad_id)
+        self.property_type = property_type
+        self.ad_type = ad_type
+        self.date = date
+        for field in FIELDS[4:]:  # the fields after the ones of the search, set by the parser
+            setattr(self, field, None)
+        self.features = 0
+
+    def set_feature(self, feature):
+        """ set boolean feature (one of config.BOOLEAN_FEATURES) to True """
+        self.features |= FEATURE_BITS[feature]
+
+    def feature_values(self):
+        """ return tuple of the values of the boolean features, in config.BOOLEAN_FEATURES order """
+        values = FEATURE_VALUES.get(self.features)
+        if values is None:
+            values = FEATURE_VALUES[self.features] = tuple(bool(self.features & bit) for bit in FEATURE_BITS.values())
+        return values
+
+    def as_dict(self):
+        """ return dictionary {field: value}, with one key per boolean feature """
+        details = {field: getattr(self, field) for field in FIELDS}
+        details.update(zip(config.BOOLEAN_FEATURES, self.feature_values()))
+
+        return details
+
+    def __repr__(self):
+        return f'AdRecord({self.as_dict()})'
@@ -0,0 +1,148 @@
+"""
+module with the agent contact details stage of Real Estate scraper.
+The name and phone of a real estate agent are not in the detailed ad page: they come from a separate API request
+(showPhone.api.asp), equivalent to clicking on the 'phone' button of the ad.
+Lookups are made by agent (contact_website_id), not by ad:
+- agents already in the contacts table are skipped, their details are not written again anyway.
+- agents looked up in a previous run are read from a local store (SQLite file) until their record expires.
+- concurrent lookups of the same agent share a single request.
+This module defines functions to be used by realestatescraper.py, thus there is no main() function.
+"""
+
+import json
+import logging
+import sqlite3
+import time
+
+import gevent.event
+
+import config
+import updatedb
+
+
+logger = logging.getLogger('scraper')
+
+
+class AgentStore:
+    """ agents' names and phones persisted across runs in a SQLite file, with a time to live """
+
+    def __init__(self, path=config.AGENT_STORE, ttl=config.AGENT_TTL):
+        """
+        :param path: path of the SQLite file. Created if missing.
+        :param ttl: seconds after which a stored agent is looked up again
+        """
+        self.ttl = ttl
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS agents ('
+                                'website_id INTEGER PRIMARY KEY, name TEXT, phone TEXT, fetched_at REAL)')
+        self.connection.commit()
+
+    def get(self, website_id):
+        """ return (name, phone) of the agent, or None if not stored or expired """
+        row = self.connection.execute('SELECT name, phone FROM agents WHERE website_id = ? AND fetched_at > ?',
+                                      (website_id, time.time() - self.ttl)).fetchone()
+        return row
+
+    def put(self, website_id, name, phone):
+        """ store (or refresh) the name and phone of the agent """
+        self.connection.execute('INSERT OR REPLACE INTO agents (website_id, name, phone, fetched_at) '
+                                'VALUES (?, ?, ?, ?)', (website_id, name, phone, time.time()))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class AgentLookup:
+    """ agent contact details, looked up once per agent and per run """
+
+    def __init__(self, engine, store=None):
+        """
+        :param engine: FetchEngine instance, used for the API requests
+        :param store: AgentStore instance, or None not to persist agents across runs
+        """
+        self.engine = engine
+        self.store = store
+        self.lookups = {}  # {website_id: AsyncResult with (name, phone)}
+        self.stats = {'known': 0, 'stored': 0, 'shared': 0, 'requests': 0}
+
+    def request(self, luachnum, modaanum):
+        """
+        API request for an agent's phone, equivalent to clicking on the 'phone' button on the ad site.
+        :return: (name, phone), or (None, None) if the request failed
+        """
+        url = ''.join(['https://www.komo.co.il/api/modaotActions/showPhone.api.asp', '?',
+                       'luachNum=', str(luachnum), '&', 'modaaNum=', str(modaanum)])
+        self.stats['requests'] += 1
+        r = self.engine.fetch(url, 'api')
+        if not r:
+            return None, None
+        try:
+            agent_details = json.loads(r.text)
+            if agent_details['status'] != 'OK':
+                return None, None
+            return agent_details['data']['name'], ''.join([agent_details['data']['phone1_pre'],
+                                                           agent_details['data']['phone1']])
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f'URL: {url} {repr(e)}')
+            return None, None
+
+    def lookup(self, website_id, luachnum, modaanum):
+        """
+        get (name, phone) of an agent, blocking only the current greenlet.
+        A lookup already in flight for the same agent is waited for instead of sending another request.
+        If the lookup fails or raises, the ads waiting for it get (None, None) and it is not kept:
+        the next ad of the agent looks it up again. An exception is raised to the caller.
+        :param website_id: agent id in the website (contact_website_id)
+        :param luachnum: param luach number of one of the agent's ads
+        :param modaanum: param modaa number of one of the agent's ads
+        """
+        if website_id in self.lookups:
+            self.stats['shared'] += 1
+            return self.lookups[website_id].get()
+        result = gevent.event.AsyncResult()
+        self.lookups[website_id] = result
+        try:
+            stored = self.store.get(website_id) if self.store else None
+            if stored:
+                self.stats['stored'] += 1
+                result.set(stored)
+                return stored
+            name, phone = self.request(luachnum, modaanum)
+            if name is not None and self.store:
+                self.store.put(website_id, name, phone)
+            result.set((name, phone))
+            if name is None:
+                # failed request: the ads waiting for it get (None, None), the next ad of the agent tries again.
+                del self.lookups[website_id]
+        finally:
+            if not result.ready():
+                # the store or the request raised: release the ads waiting for this agent without details,
+                # and let the next ad of the agent look it up again.
+                result.set((None, None))
+                del self.lookups[website_id]
+
+        return name, phone
+
+    def add_contact_details(self, details, luachnum, modaanum):
+        """
+        add contact name and phone to the details of a parsed ad. Private individuals have none.
+        Agents already in the contacts table are not looked up: their name and phone are left as None,
+        as the database keeps the record written the first time.
+        :param details: AdRecord returned by realestatescraper.parse_ad_page()
+        :param luachnum: param luach number for the agent phone API request
+        :param modaanum: param modaa number for the agent phone API request
+        """
+        details.contact_name = None
+        details.contact_phone = None
+        if details.contact_type != 'מתיווך':
+            return
+        website_id = details.contact_website_id
+        if website_id is None:
+            # agent without id: cannot be shared or stored
+            details.contact_name, details.contact_phone = self.request(luachnum, modaanum)
+            return
+        if website_id in updatedb.dimension_cache.contacts:
+            self.stats['known'] += 1
+            return
+        details.contact_name, details.contact_phone = self.lookup(website_id, luachnum, modaanum)
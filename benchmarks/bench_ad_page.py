@@ -0,0 +1,66 @@
+"""
+micro-benchmark for parsing detailed ad pages.
+Compares collecting the tags of a detailed ad page in a single pass (realestatescraper.collect_ad_page_tags())
+with one find()/find_all() per field and per boolean feature, as the ad page parser used to do,
+and times the whole parse_ad_page() on top of it.
+Run from the repository root:
+python benchmarks/bench_ad_page.py
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import htmlparser
+import realestatescraper
+
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'detail_agent.html')
+
+
+def find_ad_page_tags_repeatedly(soup):
+    """ reference implementation: one tree search per field in AD_PAGE_FIELDS and per boolean feature """
+    tags = {}
+    for field, name, attribute, value, keep_all in realestatescraper.AD_PAGE_FIELDS:
+        if keep_all:
+            found = soup.find_all(name, attrs={attribute: value})
+        else:
+            found = soup.find(name, attrs={attribute: value})
+        if found:
+            tags[field] = found
+    for feature in config.BOOLEAN_FEATURES:
+        if soup.find(attrs={'class': f'{feature} add'}):
+            tags[feature] = True
+
+    return tags
+
+
+def main():
+    parser = argparse.ArgumentParser(description='micro-benchmark for parsing detailed ad pages.')
+    parser.add_argument('-n', '--number', default=200, type=int, help='number of pages per measurement')
+    parser.add_argument('--parser', default=htmlparser.default_backend(), choices=htmlparser.available_backends(),
+                        help='HTML parser backend')
+    args = parser.parse_args()
+
+    with open(FIXTURE, encoding='utf-8') as f:
+        html_doc = f.read()
+    soup = htmlparser.make_soup(html_doc, 'detail', args.parser)
+    assert realestatescraper.collect_ad_page_tags(soup) == find_ad_page_tags_repeatedly(soup)
+
+    cases = {'find per field': lambda: find_ad_page_tags_repeatedly(soup),
+             'single pass': lambda: realestatescraper.collect_ad_page_tags(soup),
+             'parse_ad_page (tree given)': lambda: realestatescraper.parse_ad_page(soup, '1', 1, 1, '2022-08-01'),
+             'parse_ad_page (with tree building)': lambda: realestatescraper.parse_ad_page(
+                 htmlparser.make_soup(html_doc, 'detail', args.parser), '1', 1, 1, '2022-08-01')}
+    print(f'{os.path.basename(FIXTURE)}: {len(html_doc.encode())} bytes, parser: {args.parser}')
+    for name, func in cases.items():
+        seconds = min(timeit.repeat(func, number=args.number, repeat=3)) / args.number
+        print(f'{name:40} {seconds * 1000:8.3f} ms/page {1 / seconds:10.1f} pages/s')
+
+
+if __name__ == '__main__':
+    main()
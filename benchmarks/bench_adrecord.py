@@ -0,0 +1,97 @@
+"""
+benchmark for the memory and conversion cost of the scraped ad records (see adrecord.py).
+Parses the detailed ad fixtures into as many records as the database writer buffers (config.DEFAULT_SCRAPEDICSIZE),
+and reports for AdRecord and for a dictionary with the same values (AdRecord.as_dict()):
+the size of a record pickled back from a parse worker, the memory held per buffered record once unpickled
+(tracemalloc), and the time to get the values of the property_details columns
+(updatedb.get_property_details_values(), called for every ad written).
+Every value of the records is checked to be a plain Python object: a bs4 string would keep its whole page alive.
+Run from the repository root:
+python benchmarks/bench_adrecord.py
+"""
+
+import argparse
+import gc
+import os
+import pickle
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import htmlparser
+import realestatescraper
+import updatedb
+from bs4.element import PageElement
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+# one page of an agent and one of a private announcer, parsed alternately
+PAGES = ['detail_agent.html', 'detail_private.html']
+TODAY = '2022-08-01'
+
+
+def parse_records(html_docs, n, backend):
+    """ parse n detailed ad pages (with distinct ad ids), as the crawler does before the agent stage """
+    records = []
+    for i in range(n):
+        details, _ = realestatescraper.parse_ad_page(htmlparser.make_soup(html_docs[i % len(html_docs)], 'detail',
+                                                                          backend),
+                                                     str(3900000 + i), 1, 1, TODAY)
+        details.listing_hash = '0123456789abcdef0123456789abcdef01234567'
+        records.append(details)
+
+    return records
+
+
+def held_bytes(blobs):
+    """ unpickle the records, return the bytes they hold (tracemalloc) and the records """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        records = [pickle.loads(blob) for blob in blobs]
+        gc.collect()
+        held = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    return held, records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark for the memory and conversion cost of ad records.')
+    parser.add_argument('-n', '--number', default=config.DEFAULT_SCRAPEDICSIZE, type=int,
+                        help='number of records (default: the size of the database writer buffer)')
+    parser.add_argument('--parser', default=htmlparser.default_backend(), choices=htmlparser.available_backends(),
+                        help='HTML parser backend')
+    args = parser.parse_args()
+
+    html_docs = []
+    for page in PAGES:
+        with open(os.path.join(FIXTURES, page), encoding='utf-8') as f:
+            html_docs.append(f.read())
+
+    records = parse_records(html_docs, args.number, args.parser)
+    assert not any(isinstance(value, PageElement) for record in records for value in record.as_dict().values()), \
+        'bs4 objects in the records'
+    cases = {'AdRecord': records,
+             'dict': [record.as_dict() for record in records]}
+    print(f'{args.number} records from {", ".join(PAGES)}, parser: {args.parser}')
+    for name, case_records in cases.items():
+        blobs = [pickle.dumps(record) for record in case_records]
+        held, _ = held_bytes(blobs)
+        print(f'{name:10} pickled {sum(map(len, blobs)) / len(blobs):6.0f} B/record   '
+              f'held {held / len(blobs):8.0f} B/record')
+
+    seconds = min(timeit.repeat(lambda: [updatedb.get_property_details_values(record) for record in records],
+                                number=10, repeat=3)) / (10 * len(records))
+    print(f'get_property_details_values {seconds * 1e6:8.2f} us/record')
+    seconds = min(timeit.repeat(lambda: [record.as_dict() for record in records],
+                                number=10, repeat=3)) / (10 * len(records))
+    print(f'as_dict                     {seconds * 1e6:8.2f} us/record')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+benchmark for the lookups made while feeding the database, with and without the indexes of migratedb.py.
+For each table size, a scratch database is filled with properties and prices, and random lookups
+of a property by website_id and of the latest price of a property are timed before and after
+the indexes of migration 1 are added.
+Needs a MySQL server and credentials.ini. The scratch database is dropped at the end.
+Run from the repository root:
+python benchmarks/bench_db_lookups.py --sizes 1000 10000 100000
+"""
+
+import argparse
+import configparser
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import migratedb
+import updatedb
+
+
+BENCH_DB_NAME = f'{config.DB_NAME}_bench'
+PRICES_PER_PROPERTY = 3
+CHUNK = 5000
+
+# the latest price is the one of the last prices record of the property, as in updatedb.insert_latest_prices()
+LOOKUPS = {'property by website_id': 'SELECT id FROM properties WHERE website_id = %s',
+           'latest price of property': 'SELECT price FROM prices '
+                                       'WHERE id = (SELECT MAX(id) FROM prices WHERE property_id = %s)'}
+
+
+def create_tables(connection):
+    """ (re)create the scratch properties and prices tables, as created by createdb.py (no indexes) """
+    with connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS properties, prices;')
+        cursor.execute('CREATE TABLE properties (id int PRIMARY KEY AUTO_INCREMENT, website_id int, '
+                       'property_type_id int, ad_type_id int, city_id int, contact_id int);')
+        cursor.execute('CREATE TABLE prices (id int PRIMARY KEY AUTO_INCREMENT, property_id int, '
+                       'date date, price int);')
+
+
+def fill_tables(size, connection):
+    """ insert size properties with PRICES_PER_PROPERTY prices each, return the list of website ids """
+    website_ids = random.sample(range(1, 100 * size), size)
+    with connection.cursor() as cursor:
+        for start in range(0, size, CHUNK):
+            rows = [(website_id, 1, 1, 1, 1) for website_id in website_ids[start:start + CHUNK]]
+            cursor.executemany('INSERT INTO properties (website_id, property_type_id, ad_type_id, city_id, contact_id) '
+                               'VALUES (%s, %s, %s, %s, %s)', rows)
+        for start in range(0, size, CHUNK):
+            rows = [(property_id, f'2022-08-{day:02}', 1000000 + property_id)
+                    for property_id in range(start + 1, min(start + CHUNK, size) + 1)
+                    for day in range(1, PRICES_PER_PROPERTY + 1)]
+            cursor.executemany('INSERT INTO prices (property_id, date, price) VALUES (%s, %s, %s)', rows)
+    connection.commit()
+
+    return website_ids
+
+
+def time_lookups(size, website_ids, number, connection):
+    """ return {lookup name: average seconds per lookup} for number random lookups """
+    samples = {'property by website_id': random.choices(website_ids, k=number),
+               'latest price of property': random.choices(range(1, size + 1), k=number)}
+    timings = {}
+    with connection.cursor() as cursor:
+        for name, sql in LOOKUPS.items():
+            start = time.perf_counter()
+            for value in samples[name]:
+                cursor.execute(sql, (value,))
+                cursor.fetchall()
+            timings[name] = (time.perf_counter() - start) / number
+
+    return timings
+
+
+def add_indexes(connection):
+    """ add the properties and prices indexes of migration 1 """
+    migratedb.add_index('properties', 'ux_properties_website_id', ['website_id'], connection, unique=True)
+    migratedb.add_index('prices', 'ix_prices_property_id_date', ['property_id', 'date'], connection)
+
+
+def run(sizes, number, connection):
+    """ print lookup latencies for each table size, before and after adding the indexes """
+    print(f'{"rows":>10} {"lookup":28} {"no index (ms)":>14} {"indexed (ms)":>14}')
+    for size in sizes:
+        create_tables(connection)
+        website_ids = fill_tables(size, connection)
+        before = time_lookups(size, website_ids, number, connection)
+        add_indexes(connection)
+        after = time_lookups(size, website_ids, number, connection)
+        for name in LOOKUPS:
+            print(f'{size:>10} {name:28} {before[name] * 1000:14.3f} {after[name] * 1000:14.3f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark for database lookups with and without indexes.')
+    parser.add_argument('--sizes', nargs='+', default=[1000, 10000, 100000], type=int,
+                        help='numbers of properties to benchmark')
+    parser.add_argument('-n', '--number', default=200, type=int, help='number of lookups per measurement')
+    args = parser.parse_args()
+
+    cred = configparser.ConfigParser()
+    cred.read('credentials.ini')
+    connection = updatedb.connect(cred)
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE DATABASE IF NOT EXISTS {BENCH_DB_NAME};')
+        cursor.execute(f'USE {BENCH_DB_NAME};')
+    try:
+        run(args.sizes, args.number, connection)
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP DATABASE {BENCH_DB_NAME};')
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
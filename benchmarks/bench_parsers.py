@@ -0,0 +1,183 @@
+"""
+micro-benchmark suite for the page parsers, on the fixture corpus in benchmarks/fixtures.
+The corpus has a quicklink page, a result page with more result pages and one without,
+and detailed ad pages of an agent, of a private announcer, without address nor neighborhood, of an inactive ad,
+and of an agent whose floors and office name are split by nested markup (they have no single string: None).
+For each parser and page, the output is first checked against the golden results (fixtures/golden.json),
+so that a faster parser cannot silently change what is written to the database.
+Detailed ad pages are also parsed in parse worker processes, whose results must equal the serial path's
+(they are pickled back to the crawler).
+Then it reports pages/s (tree building included, with the partial parsing used by the crawler)
+and the peak memory allocated by one call (tracemalloc).
+Detailed ad pages are measured without the agent's phone API request (see agentlookup.py).
+Run from the repository root:
+python benchmarks/bench_parsers.py
+After a deliberate change of the parsers' output, review the differences and regenerate the golden results with:
+python benchmarks/bench_parsers.py --update-golden
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import htmlparser
+import realestatescraper
+from parsepool import ParsePool
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+GOLDEN = os.path.join(FIXTURES, 'golden.json')
+TODAY = '2022-08-01'
+
+# benchmark cases: (name, fixture file, page type for partial parsing, function of the parsed page).
+# Results must be JSON serializable, as they are compared with the golden results.
+CASES = [('get_city_urls all', 'quicklinks.html', 'quicklink',
+          lambda soup: realestatescraper.get_city_urls(None, 1, soup)),
+         ('get_city_urls Jerusalem', 'quicklinks.html', 'quicklink',
+          lambda soup: realestatescraper.get_city_urls('Jerusalem', 1, soup)),
+         ('get_pages multipage', 'listing_multipage.html', 'listing', realestatescraper.get_pages),
+         ('get_pages single', 'listing_single.html', 'listing', realestatescraper.get_pages),
+         ('get_listing_rows multipage', 'listing_multipage.html', 'listing', realestatescraper.get_listing_rows),
+         ('get_listing_rows single', 'listing_single.html', 'listing', realestatescraper.get_listing_rows)]
+
+# detailed ad pages: (name, fixture file, ad id, property type, ad type)
+DETAIL_CASES = [('parse_ad_page agent', 'detail_agent.html', '3987676', 1, 1),
+                ('parse_ad_page private', 'detail_private.html', '3865660', 1, 2),
+                ('parse_ad_page no address', 'detail_no_address.html', '4012345', 1, 1),
+                ('parse_ad_page inactive', 'detail_inactive.html', '4000000', 1, 1),
+                ('parse_ad_page nested markup', 'detail_nested_markup.html', '3987676', 1, 1)]
+CASES += [(name, fixture, 'detail',
+           lambda soup, args=args: ad_result(realestatescraper.parse_ad_page(soup, *args, TODAY)))
+          for name, fixture, *args in DETAIL_CASES]
+
+
+def ad_result(result):
+    """ JSON serializable form of the result of parse_ad_page(): (AdRecord or None, phone params) """
+    details, phone_params = result
+    return details.as_dict() if details else None, phone_params
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def run_case(func, html_doc, page, backend):
+    """ parse the page as the crawler does and apply the parser function, return its result """
+    return func(htmlparser.make_soup(html_doc, page, backend))
+
+
+def normalize(result):
+    """ JSON round trip, so that tuples compare equal to the lists read from the golden file """
+    return json.loads(json.dumps(result, ensure_ascii=False))
+
+
+def check_golden(backend, update=False):
+    """
+    compare the output of each case with the golden results, or regenerate them if update is True.
+    :return: list of names of the cases whose output differs
+    """
+    results = {name: normalize(run_case(func, load_fixture(fixture), page, backend))
+               for name, fixture, page, func in CASES}
+    if update:
+        with open(GOLDEN, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=1, sort_keys=True)
+        print(f'Golden results written to {GOLDEN}.')
+        return []
+    with open(GOLDEN, encoding='utf-8') as f:
+        golden = json.load(f)
+    mismatches = [name for name in results if results[name] != golden.get(name)]
+    for name in mismatches:
+        print(f'{name}: output differs from the golden results.\n'
+              f'expected: {golden.get(name)}\n'
+              f'got:      {results[name]}')
+
+    return mismatches
+
+
+def check_parse_workers(backend, workers):
+    """
+    parse the detailed ad pages in parse worker processes (--parse-workers), as the crawler does,
+    and compare the results with the serial path: results must survive pickling unchanged.
+    :return: list of names of the cases whose output differs (or could not be sent back)
+    """
+    pool = ParsePool(workers)
+    mismatches = []
+    try:
+        for name, fixture, *args in DETAIL_CASES:
+            html_doc = load_fixture(fixture)
+            serial = ad_result(realestatescraper.parse_ad_page(htmlparser.make_soup(html_doc, 'detail', backend),
+                                                               *args, TODAY))
+            try:
+                parallel = ad_result(pool.apply(realestatescraper.parse_ad_content, html_doc.encode('utf-8'),
+                                                'utf-8', *args, TODAY, backend))
+            except Exception as e:
+                parallel = repr(e)
+            if normalize(parallel) != normalize(serial):
+                mismatches.append(name)
+                print(f'{name}: parse worker output differs from the serial path.\n'
+                      f'serial: {serial}\n'
+                      f'worker: {parallel}')
+    finally:
+        pool.close()
+
+    return mismatches
+
+
+def peak_allocation(func, html_doc, page, backend):
+    """ peak memory (bytes) allocated while parsing the page and applying the parser function once """
+    tracemalloc.start()
+    try:
+        run_case(func, html_doc, page, backend)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='micro-benchmark suite for the page parsers.')
+    parser.add_argument('-n', '--number', default=50, type=int, help='number of pages per measurement')
+    parser.add_argument('--parser', nargs='+', default=htmlparser.available_backends(),
+                        choices=htmlparser.available_backends(), help='HTML parser backends to measure')
+    parser.add_argument('-k', '--filter', default='', help='only run the cases whose name contains this string')
+    parser.add_argument('--parse-workers', default=2, type=int,
+                        help='number of parse worker processes used to check the detailed ad pages against the '
+                             'serial path (0: no check)')
+    parser.add_argument('--update-golden', action='store_true',
+                        help='flag: regenerate the golden results with the first parser backend and exit')
+    args = parser.parse_args()
+
+    if args.update_golden:
+        check_golden(args.parser[0], update=True)
+        return
+    failed = False
+    for backend in args.parser:
+        mismatches = check_golden(backend)
+        failed = failed or bool(mismatches)
+        print(f'\nparser: {backend}, golden results: {"FAILED" if mismatches else "OK"}')
+        if args.parse_workers:
+            mismatches = check_parse_workers(backend, args.parse_workers)
+            failed = failed or bool(mismatches)
+            print(f'parse workers: {"FAILED" if mismatches else "OK"}')
+        print(f'{"case":30} {"ms/page":>9} {"pages/s":>10} {"peak KiB":>9}')
+        for name, fixture, page, func in CASES:
+            if args.filter not in name:
+                continue
+            html_doc = load_fixture(fixture)
+            seconds = min(timeit.repeat(lambda: run_case(func, html_doc, page, backend),
+                                        number=args.number, repeat=3)) / args.number
+            peak = peak_allocation(func, html_doc, page, backend)
+            print(f'{name:30} {seconds * 1000:9.3f} {1 / seconds:10.1f} {peak / 1024:9.1f}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,82 @@ DEFAULT_TSIZE = 300
 
 DEFAULT_SCRAPEDICSIZE = 1000
 
+# scraped ads waiting for the database writer. When the queue is full, scraping waits for the writer.
+DEFAULT_QUEUESIZE = 2000
+
+# ads already in the database are written with one statement per set of changed columns (and per table).
+# Above this number of sets, the union of changed columns is written with a single statement.
+MAX_UPDATE_GROUPS = 8
+
+# database connection pool (see updatedb.ConnectionPool): max connections in use,
+# and seconds of inactivity after which a connection is pinged (and reconnected if needed) before use.
+DB_POOL_SIZE = 2
+DB_PING_INTERVAL = 60
+
+# max seconds between two database flushes of scraped ads, even if the buffer is not full.
+FLUSH_INTERVAL = 60
+
+# fetch engine: max requests in flight overall and per host.
+# KOMO pages and the agent phone API are served by the same host, so the per-host limit is the effective one.
+DEFAULT_CONCURRENCY = 40
+DEFAULT_HOST_CONCURRENCY = 20
+
+# seconds to wait for a server response
+REQUEST_TIMEOUT = 30
+
+# rate control (see ratecontrol.py). Failed requests are retried up to MAX_RETRIES times,
+# after a random delay of up to BACKOFF_BASE * 2 ** (retry - 1) seconds (at most BACKOFF_MAX),
+# or after the delay asked by the server in a Retry-After header (at most MAX_RETRY_AFTER).
+MAX_RETRIES = 4
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+MAX_RETRY_AFTER = 300
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+# the per-host concurrency limit is multiplied by AIMD_DECREASE on errors, retryable statuses
+# and responses slower than SLOW_RESPONSE seconds, and grows back by about 1 per round of requests.
+AIMD_DECREASE = 0.5
+SLOW_RESPONSE = 10
+
+# HTTP cache (--cache): seconds during which a cached page is used without asking the server, per crawl level.
+# 1: quicklink pages, 2: result pages, 3: detailed ad pages, 'api': agent contact details.
+# After that, the page is revalidated (or downloaded again if the server does not support revalidation).
+CACHE_TTL = {1: 24 * 3600, 2: 3600, 3: 6 * 3600, 'api': 7 * 24 * 3600}
+# max total size of the cache directory. Least recently used pages are deleted first.
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# agent contact details (see agentlookup.py): local store of agents looked up in previous runs,
+# seconds after which a stored agent is looked up again, and max number of ads waiting for agent details.
+AGENT_STORE = 'agents.sqlite'
+AGENT_TTL = 30 * 24 * 3600
+AGENT_CONCURRENCY = 100
+
+# crawl frontier (see frontier.py): file recording the work units of the current crawl for --resume,
+# and max seconds between two checkpoints of the frontier to disk.
+FRONTIER_PATH = 'frontier.sqlite'
+CHECKPOINT_INTERVAL = 10
+
+# shared work queue of a crawl split between worker processes (see workqueue.py): seconds during which a claimed
+# unit belongs to its worker (renewed while the worker is alive), number of city units claimed at a time,
+# attempts before a unit is given up, seconds to wait for the file lock, and seconds between two claims
+# of an idle worker while other workers hold units (their leases may expire).
+WORKER_LEASE = 600
+WORKER_BATCH = 4
+WORKER_MAX_ATTEMPTS = 3
+WORKER_LOCK_TIMEOUT = 30
+WORKER_POLL = 30
+
+# metrics (see metrics.py): seconds between two snapshots written to the --metrics file.
+METRICS_INTERVAL = 15
+
+# profiling mode (see profiler.py): seconds between two checks for a new peak of traced memory
+# (snapshot of the allocation sites), number of lines in each top list of the reports.
+PROFILE_SNAPSHOT_INTERVAL = 30
+PROFILE_TOP = 25
+
+# HTML parser backends (BeautifulSoup tree builders). The default falls back to 'html.parser' if lxml is not installed.
+PARSER_BACKENDS = ['lxml', 'html.parser']
+DEFAULT_PARSER = 'lxml'
+
 BOOLEAN_FEATURES = ['mamad', 'mirpeset', 'mahsan', 'soragim', 'mizug',
                     'riut', 'gisha', 'maalit', 'hania', 'shutafim',
                     'pets', 'boiler']
@@ -136,5 +212,11 @@ CITIES_API_KOMO = {'בני עי"ש': 'בני עייש',
                    'קרית שמונה': 'קריית שמונה',
                    'תל אביב - יפו': 'תל אביב יפו'}
 
-API_DOMAIN = 'https://data.gov.il'
 API_URL = 'https://data.gov.il/api/3/action/datastore_search?resource_id=64edd0ee-3d5d-43ce-8562-c336c24dbc1f'
+# records per API request (the server caps it at 32000) and max number of API requests at the same time.
+API_PAGE_SIZE = 1000
+API_CONCURRENCY = 4
+# local snapshot of the last demographics dataset written to the database (see queryapi.Snapshot).
+API_SNAPSHOT = 'demographics.snapshot'
+# pages of API records waiting for the database writer. When the queue is full, the download waits for the writer.
+API_QUEUESIZE = 4
@@ -8,6 +8,7 @@ import config
 import configparser
 
 import updatedb
+import migratedb
 
 
 def create_db(connection):
@@ -136,6 +137,7 @@ def main():
                                  cursorclass=pymysql.cursors.DictCursor)
     create_db(connection)
     preload_db(connection)
+    migratedb.migrate(connection)
     connection.close()
 
 
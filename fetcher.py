@@ -0,0 +1,165 @@
+"""
+module with the fetch engine for Real Estate scraper.
+The engine schedules GET requests in gevent greenlets under a global concurrency limit
+and an adaptive per-host concurrency limit (see ratecontrol.py), so that the three crawl levels can be pipelined:
+a callback that parses a page may submit the next level's urls right away.
+Requests only wait cooperatively if sockets were monkey-patched by gevent before requests was imported:
+this is done by the entry point (realestatescraper.py), not here, so that importing this module has no side effect.
+This module defines functions to be used by realestatescraper.py, thus there is no main() function.
+"""
+
+import gevent
+import gevent.event
+import heapq
+import itertools
+import logging
+import time
+import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+import profiler
+import ratecontrol
+from metrics import registry
+
+
+logger = logging.getLogger('scraper')
+
+
+class FetchEngine:
+    """
+    Bounded-concurrency fetch engine.
+    Work units (url, callback, args) are kept in a priority queue and dispatched to greenlets
+    while there are less than `concurrency` units in flight.
+    Units of deeper crawl levels are dispatched first, so detailed ad pages of a parsed listing page
+    go out before further listing pages, and the queue of pending units stays small.
+    A unit holds its global slot until its callback returns, so a callback that blocks
+    (e.g. on a full queue downstream) slows fetching down instead of piling up responses.
+    """
+
+    def __init__(self, concurrency=config.DEFAULT_CONCURRENCY, host_concurrency=config.DEFAULT_HOST_CONCURRENCY,
+                 cache=None):
+        """
+        :param concurrency: max number of work units in flight (request + callback).
+        :param host_concurrency: max number of requests in flight per host.
+        :param cache: httpcache.HTTPCache instance, or None to always download pages.
+        """
+        self.concurrency = concurrency
+        self.host_concurrency = host_concurrency
+        self.cache = cache
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=max(concurrency, host_concurrency))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.host_limiters = {}  # {host: ratecontrol.HostLimiter}
+        self.pending = []  # heap of (-level, sequence number, url, callback, args)
+        self.counter = itertools.count()
+        self.active = 0
+        self.idle = gevent.event.Event()
+        self.idle.set()
+
+    def host_limiter(self, url):
+        """ get (or create) the adaptive limit of requests in flight to the url's host """
+        host = urllib.parse.urlsplit(url).netloc
+        if host not in self.host_limiters:
+            self.host_limiters[host] = ratecontrol.HostLimiter(self.host_concurrency)
+        return self.host_limiters[host]
+
+    def fetch(self, url, level=1):
+        """
+        send a GET request to the specified url, blocking only the current greenlet.
+        With a cache, the response may come from disk (see httpcache.HTTPCache.request()).
+        Requests are sent under the adaptive limit of the host (see ratecontrol.py).
+        Timeouts, connection errors and retryable statuses (config.RETRY_STATUSES) are retried
+        up to config.MAX_RETRIES times, after the delay asked by the server in Retry-After or a jittered backoff.
+        With --profile, this is the fetch stage (see profiler.py).
+        :param url: url
+        :param level: crawl level of the url, selects the cache TTL.
+        :return: Response object (the last one if all attempts failed with a retryable status),
+                 or None if the request failed.
+        """
+        with profiler.stage('fetch'):
+            if self.cache:
+                r = self.cache.get_fresh(url, level)
+                if r:
+                    registry.inc('fetch_total', level=level, outcome='cache')
+                    return r
+            start = time.perf_counter()
+            r = self.fetch_with_retries(url, level)
+            registry.observe('fetch_seconds', time.perf_counter() - start, level=level)
+            if r is None:
+                registry.inc('fetch_total', level=level, outcome='error')
+            elif getattr(r, 'from_cache', False):
+                registry.inc('fetch_total', level=level, outcome='revalidated')
+            else:
+                registry.inc('fetch_total', level=level, outcome=r.status_code)
+                registry.inc('downloaded_bytes_total', len(r.content), level=level)
+            return r
+
+    def fetch_with_retries(self, url, level):
+        """ send the request of fetch() under the host limit, retrying failures. Same return value as fetch() """
+        limiter = self.host_limiter(url)
+        r = error = retry_after = None
+        for attempt in range(config.MAX_RETRIES + 1):
+            if attempt:
+                limiter.stats['retries'] += 1
+                registry.inc('fetch_retries_total', level=level)
+                logger.warning(f'URL: {url} {repr(error) if r is None else r.status_code}, retry {attempt}')
+                if retry_after is None:
+                    gevent.sleep(ratecontrol.backoff_delay(attempt))
+            started = limiter.acquire()  # waits for the pause asked in Retry-After, if any
+            r = None
+            try:
+                if self.cache:
+                    r = self.cache.request(self.session, url, level, timeout=config.REQUEST_TIMEOUT)
+                else:
+                    r = self.session.get(url, timeout=config.REQUEST_TIMEOUT)
+            except requests.RequestException as e:
+                error = e
+            except BaseException:
+                limiter.release(started, False)
+                raise
+            retry_after = ratecontrol.get_retry_after(r)
+            limiter.release(started, not ratecontrol.is_retryable(r), retry_after)
+            if not ratecontrol.is_retryable(r):
+                return r
+
+        logger.error(f'URL: {url} {repr(error) if r is None else r.status_code} after {attempt + 1} attempts')
+        return r
+
+    def submit(self, url, callback, *args, level=1):
+        """
+        schedule a work unit: fetch url and call callback(response, *args).
+        response is None if the request failed.
+        :param url: url
+        :param callback: function to be called with the response and args
+        :param args: extra positional arguments for callback
+        :param level: crawl level of the url. Deeper levels are dispatched first.
+        """
+        heapq.heappush(self.pending, (-level, next(self.counter), url, callback, args))
+        self.idle.clear()
+        self.dispatch()
+
+    def dispatch(self):
+        """ start pending work units while there are free global slots """
+        while self.pending and self.active < self.concurrency:
+            level, _, url, callback, args = heapq.heappop(self.pending)
+            self.active += 1
+            gevent.spawn(self.run, url, callback, args, -level)
+
+    def run(self, url, callback, args, level):
+        """ run a single work unit in its own greenlet """
+        try:
+            callback(self.fetch(url, level), *args)
+        except Exception as e:
+            logger.error(f'URL: {url} {repr(e)}')
+        finally:
+            self.active -= 1
+            self.dispatch()
+            if not self.active and not self.pending:
+                self.idle.set()
+
+    def join(self):
+        """ block until all submitted work units (and the ones they submitted) are done """
+        self.idle.wait()
@@ -0,0 +1,106 @@
+"""
+module with the crawl frontier of Real Estate scraper.
+Every work unit submitted to the fetch engine (quicklink page, city page, result page, detailed ad page)
+is recorded in a local SQLite file with its status, so that a crawl that crashed or was interrupted
+can be resumed (--resume) from its unfinished units instead of starting again from the quicklink pages.
+Pages are done when their callback returned. Detailed ad pages are done when their ad was written to the database.
+Recording a unit only appends to an in-memory buffer: the buffer is written to disk in a single transaction
+every config.CHECKPOINT_INTERVAL seconds by a background greenlet, after each database flush and at the end.
+The seen-set of the crawl (ad ids already submitted, see seenset.py) is checkpointed with the units.
+This module defines functions to be used by realestatescraper.py, thus there is no main() function.
+"""
+
+import json
+import logging
+import sqlite3
+
+import gevent
+
+import config
+from seenset import SeenSet
+
+
+logger = logging.getLogger('scraper')
+
+
+class Frontier:
+    """ persistent record of the work units of a crawl and of their status """
+
+    def __init__(self, path, today, resume=False):
+        """
+        :param path: path of the SQLite file. Created if missing.
+        :param today: date of the crawl in iso format. When resuming, the date of the interrupted crawl is kept.
+        :param resume: if True, keep the units of the previous crawl. Else, start a new crawl.
+        """
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS units ('
+                                'url TEXT PRIMARY KEY, kind TEXT, args TEXT, level INTEGER, done INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'today'").fetchone()
+        if resume and row:
+            self.today = row[0]
+            self.done_urls = {url for url, in self.connection.execute('SELECT url FROM units WHERE done = 1')}
+            seen = self.connection.execute("SELECT value FROM meta WHERE key = 'seen'").fetchone()
+            self.seen = SeenSet.from_bytes(seen[0]) if seen else SeenSet()
+        else:
+            self.today = today
+            self.done_urls = set()
+            self.seen = SeenSet()
+            self.connection.execute('DELETE FROM units')
+            self.connection.execute("DELETE FROM meta WHERE key = 'seen'")
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('today', ?)", (today,))
+        self.connection.commit()
+        self.seen_saved = len(self.seen)  # size of the seen-set at the last checkpoint
+        self.added = []  # units recorded since the last checkpoint: (url, kind, args, level, 0)
+        self.finished = []  # units done since the last checkpoint: (url,)
+        self.checkpointer = None
+
+    def pending_units(self):
+        """ return list of (url, kind, args, level) of the units that were not done, in the order they were added """
+        return [(url, kind, json.loads(args), level) for url, kind, args, level in
+                self.connection.execute('SELECT url, kind, args, level FROM units WHERE done = 0 ORDER BY rowid')]
+
+    def is_done(self, url):
+        return url in self.done_urls
+
+    def add(self, url, kind, args, level):
+        """ record a submitted unit. kind names the callback that handles the page, args its arguments """
+        self.added.append((url, kind, json.dumps(args, ensure_ascii=False), level, 0))
+
+    def done(self, urls):
+        """ record units as done """
+        for url in urls:
+            self.done_urls.add(url)
+            self.finished.append((url,))
+
+    def checkpoint(self):
+        """ write units recorded since the last checkpoint, and the seen-set if it grew, in a single transaction """
+        if not self.added and not self.finished and len(self.seen) == self.seen_saved:
+            return
+        added, finished = self.added, self.finished
+        self.added, self.finished = [], []
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO units (url, kind, args, level, done) '
+                                        'VALUES (?, ?, ?, ?, ?)', added)
+            self.connection.executemany('UPDATE units SET done = 1 WHERE url = ?', finished)
+            if len(self.seen) != self.seen_saved:
+                self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('seen', ?)",
+                                        (self.seen.to_bytes(),))
+                self.seen_saved = len(self.seen)
+
+    def run_checkpoints(self):
+        """ background greenlet: checkpoint every config.CHECKPOINT_INTERVAL seconds """
+        while True:
+            gevent.sleep(config.CHECKPOINT_INTERVAL)
+            self.checkpoint()
+
+    def start(self):
+        """ start checkpointing in the background """
+        self.checkpointer = gevent.spawn(self.run_checkpoints)
+
+    def close(self):
+        """ stop background checkpoints, write the last one and close the file """
+        if self.checkpointer:
+            self.checkpointer.kill()
+        self.checkpoint()
+        self.connection.close()
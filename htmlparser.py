@@ -0,0 +1,63 @@
+"""
+module with the HTML parser backends for Real Estate scraper.
+Pages are parsed with BeautifulSoup, either with Python's "html.parser" or with the much faster "lxml" tree builder.
+Quicklink and result (listing) pages are parsed partially: only the tags that the extraction functions
+in realestatescraper.py look at are built into the tree, the rest of the page is skipped.
+This module defines functions to be used by realestatescraper.py, thus there is no main() function.
+"""
+
+import re
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.builder import builder_registry
+
+import config
+
+
+MODAAROW_ID = re.compile('modaaRowDv')
+
+
+def is_quicklink_tag(name, attrs):
+    """ partial parsing filter for quicklink pages: city links, used by get_city_urls() """
+    return name == 'div' and 'listFloatItem' in attrs.get('class', '').split()
+
+
+def is_listing_tag(name, attrs):
+    """
+    partial parsing filter for result pages: ad rows, used by get_listing_rows(),
+    and paging links, used by get_pages()
+    """
+    if name == 'div':
+        return bool(MODAAROW_ID.search(attrs.get('id', '')))
+    if name == 'a':
+        return 'paging' in attrs.get('class', '').split()
+    return False
+
+
+# partial parsing filters by page type. None means that the whole page is parsed.
+# filters get the raw tag name and attributes while the page is parsed (bs4 4.11 SoupStrainer API).
+PAGE_FILTERS = {'quicklink': SoupStrainer(is_quicklink_tag),
+                'listing': SoupStrainer(is_listing_tag),
+                'detail': None}
+
+
+def available_backends():
+    """ return the names of the parser backends installed in the system """
+    return [backend for backend in config.PARSER_BACKENDS if builder_registry.lookup(backend)]
+
+
+def default_backend():
+    """ return config.DEFAULT_PARSER if installed, else Python's built-in "html.parser" """
+    return config.DEFAULT_PARSER if config.DEFAULT_PARSER in available_backends() else 'html.parser'
+
+
+def make_soup(html_doc, page=None, backend=None):
+    """
+    parse an HTML document into a soup object.
+    :param html_doc: HTML document (str)
+    :param page: page type: 'quicklink', 'listing' or 'detail' (see PAGE_FILTERS). If None, parse the whole page.
+    :param backend: parser backend, see config.PARSER_BACKENDS. If None, default_backend().
+    :return: parsed soup object
+    """
+    soup = BeautifulSoup(html_doc, backend or default_backend(), parse_only=PAGE_FILTERS.get(page))
+
+    return soup
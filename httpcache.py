@@ -0,0 +1,148 @@
+"""
+module with the on-disk HTTP cache for Real Estate scraper.
+Bodies of successful GET responses are stored on disk, one file per url.
+A cached response younger than the TTL of its crawl level (config.CACHE_TTL) is used without a request.
+An older one is revalidated with If-None-Match / If-Modified-Since when the server sent ETag / Last-Modified,
+and a 304 Not Modified answer is served from the cache.
+The total size is capped: least recently used files are deleted first (file mtime is the time of last use).
+This module defines functions to be used by realestatescraper.py and fetcher.py, thus there is no main() function.
+"""
+
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+import config
+
+
+logger = logging.getLogger('scraper')
+
+# response headers kept in the cache: enough to rebuild the response and to revalidate it.
+KEPT_HEADERS = ['Content-Type', 'ETag', 'Last-Modified']
+
+
+class HTTPCache:
+    """ on-disk cache of GET responses, with per-level TTL, conditional revalidation and LRU eviction """
+
+    def __init__(self, directory, max_bytes=config.CACHE_MAX_BYTES, ttls=config.CACHE_TTL):
+        """
+        :param directory: cache directory. Created if missing.
+        :param max_bytes: max total size of cached files
+        :param ttls: dictionary {crawl level: seconds during which a cached response is used without revalidation}
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttls = ttls
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(os.path.getsize(path) for path in self.files())
+        self.stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+
+    def files(self):
+        """ list the paths of all cached files """
+        return [os.path.join(root, name) for root, _, names in os.walk(self.directory)
+                for name in names if not name.startswith('.')]
+
+    def path(self, url):
+        """ path of the cache file of url """
+        key = hashlib.sha1(url.encode()).hexdigest()
+        return os.path.join(self.directory, key[:2], key)
+
+    def load(self, url):
+        """ return the cache entry of url (dictionary), or None if not cached """
+        try:
+            with open(self.path(url), 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        return entry if entry['url'] == url else None
+
+    def store(self, entry):
+        """ write a cache entry to disk atomically, evicting least recently used files if over the size cap """
+        path = self.path(entry['url'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        self.size += os.path.getsize(path) - old_size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """ delete least recently used files until the cache is at 90% of its size cap """
+        files = sorted(self.files(), key=os.path.getmtime)
+        self.size = sum(os.path.getsize(path) for path in files)
+        for path in files:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            self.size -= os.path.getsize(path)
+            os.remove(path)
+
+    @staticmethod
+    def to_response(entry):
+        """ rebuild a Response object from a cache entry """
+        r = requests.Response()
+        r.url = entry['url']
+        r.status_code = 200
+        r.headers = CaseInsensitiveDict(entry['headers'])
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        r._content = entry['content']
+        r.from_cache = True
+        return r
+
+    def is_fresh(self, entry, level):
+        """ check if a cache entry can be used without asking the server """
+        return time.time() - entry['stored_at'] < self.ttls.get(level, 0)
+
+    def hit(self, entry):
+        """ return the response of a fresh cache entry, marking it as recently used """
+        self.stats['hits'] += 1
+        os.utime(self.path(entry['url']))
+        return self.to_response(entry)
+
+    def get_fresh(self, url, level):
+        """ return the cached response of url if it can be used without asking the server, else None """
+        entry = self.load(url)
+        return self.hit(entry) if entry and self.is_fresh(entry, level) else None
+
+    def request(self, session, url, level, **kwargs):
+        """
+        GET url through the cache.
+        :param session: requests.Session, or the requests module
+        :param url: url
+        :param level: crawl level of the url (key of the TTL dictionary)
+        :param kwargs: extra arguments for session.get(), e.g. timeout
+        :return: Response object. Request exceptions are raised as with session.get().
+        """
+        entry = self.load(url)
+        if entry and self.is_fresh(entry, level):
+            return self.hit(entry)
+
+        headers = {}
+        if entry and entry['headers'].get('ETag'):
+            headers['If-None-Match'] = entry['headers']['ETag']
+        if entry and entry['headers'].get('Last-Modified'):
+            headers['If-Modified-Since'] = entry['headers']['Last-Modified']
+        r = session.get(url, headers=headers, **kwargs)
+
+        if r.status_code == 304 and entry:
+            self.stats['revalidated'] += 1
+            entry['headers'].update({k: r.headers[k] for k in KEPT_HEADERS if k in r.headers})
+            entry['stored_at'] = time.time()
+            self.store(entry)
+            return self.to_response(entry)
+
+        self.stats['misses'] += 1
+        if r.status_code == 200:
+            self.store({'url': url,
+                        'headers': {k: r.headers[k] for k in KEPT_HEADERS if k in r.headers},
+                        'content': r.content,
+                        'stored_at': time.time()})
+        return r
@@ -0,0 +1,176 @@
+"""
+module with the metrics of Real Estate scraper.
+Counters, gauges and histograms are kept in a process-wide registry (metrics.registry) and updated by the
+fetch engine, the parse stages, the database writer and the API loader.
+With --metrics PATH, a snapshot of all metrics is written to PATH every config.METRICS_INTERVAL seconds and at the end
+of the run: in Prometheus text format if PATH ends with .prom, in JSON otherwise.
+Metric names and what they tell:
+- fetch_seconds{level}, downloaded_bytes_total{level}, fetch_total{level, outcome}: network.
+- parse_seconds{page}: parsing (CPU).
+- db_round_trips_total, db_query_seconds, db_commit_seconds, db_flush_seconds, db_records_written_total: database.
+- api_request_seconds, api_records_total: demographics API.
+- queue gauges (records_queue, pending_units, active_units, agent_stage, host_limit{host}): where work piles up.
+This module defines functions to be used by the other modules, thus there is no main() function.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+import gevent
+
+import config
+
+
+logger = logging.getLogger('scraper')
+
+# upper bounds (seconds) of the histogram buckets
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+def label_key(labels):
+    """ hashable key for a dictionary of labels """
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Registry:
+    """ process-wide store of counters, gauges and histograms, each identified by a name and labels """
+
+    def __init__(self):
+        self.counters = {}  # {name: {label key: value}}
+        self.gauges = {}  # {name: {label key: value}}
+        self.gauge_functions = {}  # {name: function returning {label key: value}}, sampled at snapshot time
+        self.histograms = {}  # {name: {label key: {'buckets': [counts], 'count': n, 'sum': total}}}
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        """ add value to a counter """
+        series = self.counters.setdefault(name, {})
+        key = label_key(labels)
+        series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """ set a gauge """
+        self.gauges.setdefault(name, {})[label_key(labels)] = value
+
+    def gauge_function(self, name, function):
+        """ register a gauge sampled when a snapshot is taken. function returns a value or {labels dict key: value} """
+        self.gauge_functions[name] = function
+
+    def observe(self, name, value, **labels):
+        """ record a value (e.g. seconds) in a histogram """
+        series = self.histograms.setdefault(name, {})
+        key = label_key(labels)
+        if key not in series:
+            series[key] = {'buckets': [0] * len(BUCKETS), 'count': 0, 'sum': 0.0}
+        histogram = series[key]
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+                break
+        histogram['count'] += 1
+        histogram['sum'] += value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """ context manager recording the seconds spent in the block in a histogram """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def sample_gauges(self):
+        """ return {name: {label key: value}} with the set gauges and the sampled gauge functions """
+        gauges = dict(self.gauges)
+        for name, function in self.gauge_functions.items():
+            try:
+                value = function()
+            except Exception as e:
+                logger.error(f'gauge {name}: {repr(e)}')
+                continue
+            gauges[name] = value if isinstance(value, dict) else {(): value}
+        return gauges
+
+    def snapshot(self):
+        """ return all metrics as a JSON-serializable dictionary """
+        def series(values):
+            return [{'labels': dict(key), 'value': value} for key, value in values.items()]
+
+        return {'timestamp': time.time(),
+                'uptime_seconds': time.time() - self.started,
+                'counters': {name: series(values) for name, values in self.counters.items()},
+                'gauges': {name: series(values) for name, values in self.sample_gauges().items()},
+                'histograms': {name: [{'labels': dict(key), 'buckets': dict(zip(BUCKETS, h['buckets'])),
+                                       'count': h['count'], 'sum': h['sum']} for key, h in values.items()]
+                               for name, values in self.histograms.items()}}
+
+    def prometheus(self):
+        """ return all metrics in Prometheus text exposition format """
+        def labels_text(key, extra=()):
+            pairs = list(key) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+        lines = []
+        for name, values in self.counters.items():
+            lines.append(f'# TYPE realestate_{name} counter')
+            lines += [f'realestate_{name}{labels_text(key)} {value}' for key, value in values.items()]
+        for name, values in self.sample_gauges().items():
+            lines.append(f'# TYPE realestate_{name} gauge')
+            lines += [f'realestate_{name}{labels_text(key)} {value}' for key, value in values.items()]
+        for name, values in self.histograms.items():
+            lines.append(f'# TYPE realestate_{name} histogram')
+            for key, h in values.items():
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h['buckets']):
+                    cumulative += count
+                    lines.append(f'realestate_{name}_bucket{labels_text(key, [("le", bound)])} {cumulative}')
+                lines.append(f'realestate_{name}_bucket{labels_text(key, [("le", "+Inf")])} {h["count"]}')
+                lines.append(f'realestate_{name}_sum{labels_text(key)} {h["sum"]}')
+                lines.append(f'realestate_{name}_count{labels_text(key)} {h["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """ write a snapshot to path atomically: Prometheus text format if path ends with .prom, else JSON """
+        text = self.prometheus() if path.endswith('.prom') else json.dumps(self.snapshot(), indent=1)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.metrics')
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+# one registry per process.
+registry = Registry()
+
+
+class MetricsWriter:
+    """ background greenlet writing registry snapshots to a file """
+
+    def __init__(self, path, interval=config.METRICS_INTERVAL):
+        """
+        :param path: output file. '.prom' extension for Prometheus text format, JSON otherwise.
+        :param interval: seconds between two snapshots
+        """
+        self.path = path
+        self.interval = interval
+        self.greenlet = None
+
+    def run(self):
+        while True:
+            gevent.sleep(self.interval)
+            registry.write(self.path)
+
+    def start(self):
+        self.greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        """ stop writing in the background and write the last snapshot """
+        if self.greenlet:
+            self.greenlet.kill()
+        registry.write(self.path)
@@ -0,0 +1,163 @@
+"""
+script to migrate the Mysql database of Real Estate scraper project to the latest schema version.
+Each migration has a version number. Applied versions are recorded in the schema_version table,
+so the script can be run against an existing database at any time and only applies what is missing.
+createdb.py runs it after creating a new database.
+"""
+
+import configparser
+from datetime import datetime
+
+import config
+import updatedb
+
+
+def table_exists(table, connection):
+    """ check if the database in use has a table called table """
+    with connection.cursor() as cursor:
+        sql = 'SELECT 1 FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s;'
+        cursor.execute(sql, (table,))
+        return bool(cursor.fetchall())
+
+
+def index_exists(table, index_name, connection):
+    """ check if table has an index called index_name """
+    with connection.cursor() as cursor:
+        sql = 'SELECT 1 FROM information_schema.statistics ' \
+              'WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s;'
+        cursor.execute(sql, (table, index_name))
+        return bool(cursor.fetchall())
+
+
+def column_exists(table, column, connection):
+    """ check if table has a column called column """
+    with connection.cursor() as cursor:
+        sql = 'SELECT 1 FROM information_schema.columns ' \
+              'WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s;'
+        cursor.execute(sql, (table, column))
+        return bool(cursor.fetchall())
+
+
+def add_column(table, column, definition, connection):
+    """ add column to table with the given SQL definition (e.g. 'char(40)'), unless it is already there """
+    if column_exists(table, column, connection):
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition};')
+
+
+def find_duplicates(table, column, connection):
+    """ return values of column that show up in more than one record of table (NULLs excluded) """
+    sql = f'SELECT {column} FROM {table} WHERE {column} IS NOT NULL GROUP BY {column} HAVING COUNT(*) > 1'
+    return [row[column] for row in updatedb.query_db(sql, connection)]
+
+
+def add_index(table, index_name, columns, connection, unique=False):
+    """
+    add index to table, unless it is already there.
+    A unique index cannot be built on a column with duplicated values, so they are checked first.
+    :param table: table name
+    :param index_name: index name
+    :param columns: list of column names
+    :param connection: connection instance
+    :param unique: True for a unique index
+    """
+    if index_exists(table, index_name, connection):
+        return
+    if unique:
+        duplicates = find_duplicates(table, columns[0], connection) if len(columns) == 1 else []
+        if duplicates:
+            raise ValueError(f'Cannot add unique index {index_name}: {table}.{columns[0]} has duplicated values '
+                             f'{duplicates[:10]}. Merge the duplicated records and run the migration again.')
+    with connection.cursor() as cursor:
+        sql = f'CREATE {"UNIQUE " if unique else ""}INDEX {index_name} ON {table} ({", ".join(columns)});'
+        cursor.execute(sql)
+
+
+def migration_1(connection):
+    """ indexes and unique keys on the columns looked up while feeding the database """
+    add_index('properties', 'ux_properties_website_id', ['website_id'], connection, unique=True)
+    add_index('contacts', 'ux_contacts_website_id', ['website_id'], connection, unique=True)
+    add_index('cities', 'ux_cities_name_heb', ['name_heb'], connection, unique=True)
+    # (property_id, date) also serves lookups by property_id alone: prices of a property, latest price.
+    add_index('prices', 'ix_prices_property_id_date', ['property_id', 'date'], connection)
+    add_index('prices', 'ix_prices_date', ['date'], connection)
+
+
+def migration_2(connection):
+    """ hash of the row of each ad in the result pages, compared by --incremental crawls """
+    add_column('properties', 'listing_hash', 'char(40)', connection)
+
+
+# {version: (description, migration function)}. Versions are applied in increasing order.
+MIGRATIONS = {1: ('indexes and unique keys on hot lookup columns', migration_1),
+              2: ('listing row hash of properties', migration_2)}
+
+
+def create_schema_version_table(connection):
+    """ create schema_version table, unless it is already there """
+    with connection.cursor() as cursor:
+        sql = 'CREATE TABLE IF NOT EXISTS schema_version (\
+               version int PRIMARY KEY,\
+               description varchar(255),\
+               applied_at datetime\
+               );'
+        cursor.execute(sql)
+
+
+def get_schema_version(connection):
+    """
+    return the latest applied version (0 if none). Read only: a database without schema_version table,
+    created before migrations existed, is at version 0.
+    """
+    if not table_exists('schema_version', connection):
+        return 0
+    res = updatedb.query_db('SELECT MAX(version) AS version FROM schema_version', connection)
+    return res[0]['version'] or 0
+
+
+def is_up_to_date(connection):
+    """ check if all migrations were applied to the database, without changing it """
+    return get_schema_version(connection) >= max(MIGRATIONS)
+
+
+def migrate(connection):
+    """
+    apply all migrations newer than the current schema version, in order.
+    Each migration is recorded in schema_version as soon as it is applied.
+    :param connection: connection instance, with the database in use
+    :return: list of applied versions
+    """
+    create_schema_version_table(connection)
+    current = get_schema_version(connection)
+    applied = []
+    for version in sorted(MIGRATIONS):
+        if version <= current:
+            continue
+        description, migration = MIGRATIONS[version]
+        print(f'Applying migration {version}: {description}')
+        migration(connection)
+        with connection.cursor() as cursor:
+            sql = 'INSERT INTO schema_version (version, description, applied_at) VALUES (%s, %s, %s);'
+            cursor.execute(sql, (version, description, datetime.now().replace(microsecond=0)))
+        connection.commit()
+        applied.append(version)
+
+    return applied
+
+
+def main():
+    cred = configparser.ConfigParser()
+    cred.read('credentials.ini')
+    connection = updatedb.connect(cred)
+    updatedb.use_db(connection)
+    applied = migrate(connection)
+    if applied:
+        print(f'Database {config.DB_NAME} migrated to version {applied[-1]}.')
+    else:
+        print(f'Database {config.DB_NAME} is up to date.')
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
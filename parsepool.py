@@ -0,0 +1,42 @@
+"""
+module with the process pool that parses detailed ad pages for Real Estate scraper.
+Parsing HTML is CPU-bound, so in the gevent loop it delays network greenlets.
+With a parse pool, raw response bytes are sent to worker processes and compact results come back,
+while the calling greenlet waits cooperatively.
+This module defines functions to be used by realestatescraper.py, thus there is no main() function.
+"""
+
+import concurrent.futures
+
+import gevent
+
+
+class ParsePool:
+    """ pool of parse worker processes usable from greenlets """
+
+    def __init__(self, workers):
+        """
+        :param workers: number of worker processes
+        """
+        self.workers = workers
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        # waiting on a future blocks a real thread, so waits run in gevent's thread pool.
+        # It needs at least one thread per worker process to keep all of them busy.
+        threadpool = gevent.get_hub().threadpool
+        threadpool.maxsize = max(threadpool.maxsize, 2 * workers)
+
+    def apply(self, func, *args):
+        """
+        run func(*args) in a worker process, blocking only the current greenlet.
+        Exceptions raised by func are re-raised here.
+        :param func: module-level (picklable) function
+        :param args: picklable arguments
+        :return: func's return value
+        """
+        future = self.executor.submit(func, *args)
+
+        return gevent.get_hub().threadpool.apply(future.result)
+
+    def close(self):
+        """ shut down worker processes """
+        self.executor.shutdown()
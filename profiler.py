@@ -0,0 +1,207 @@
+"""
+module with the profiling mode of Real Estate scraper (--profile DIR).
+The stages of the program (fetch, parse, db, api) run interleaved in gevent greenlets, so a single cProfile
+would mix them up. Each stage has its own cProfile instead, enabled only while a greenlet runs code of that stage:
+code enters a stage with `with profiler.stage(name):`, and a greenlet switch hook disables the profile of the greenlet
+that is switched out and enables the one of the greenlet that is switched in. Time spent waiting for the network or
+for a queue is not counted. Memory is traced with tracemalloc: for each stage, the peak of the process' traced memory
+while the stage was running and the net change of traced memory during its runs. Allocation sites are taken from
+a snapshot of the moment when traced memory was the highest, and assigned to a stage by the file that allocated.
+At the end of the run, the reports are written to DIR:
+- <stage>.prof: pstats file (e.g. for snakeviz), and <stage>.txt: top functions by total and cumulative time.
+- memory.txt: peak memory, per-stage memory, top allocation sites overall and per stage.
+With --parse-workers, detailed ad pages are parsed in worker processes, which are not profiled.
+This module defines functions to be used by the other modules, thus there is no main() function.
+"""
+
+import contextlib
+import cProfile
+import io
+import logging
+import os
+import pstats
+import resource
+import tracemalloc
+import weakref
+
+import gevent
+import greenlet
+
+import config
+
+
+logger = logging.getLogger('scraper')
+
+STAGES = ['fetch', 'parse', 'db', 'api']
+# files whose allocations belong to each stage in the memory report (fnmatch patterns of the allocating file).
+STAGE_FILES = {'fetch': ['*/fetcher.py', '*/httpcache.py', '*/ratecontrol.py', '*/agentlookup.py',
+                         '*/requests/*', '*/urllib3/*', '*/http/client.py', '*/email/*'],
+               'parse': ['*/realestatescraper.py', '*/htmlparser.py', '*/parsepool.py', '*/bs4/*', '*/lxml/*',
+                         '*/html/parser.py'],
+               'db': ['*/updatedb.py', '*/pymysql/*'],
+               'api': ['*/queryapi.py']}
+
+
+class Profiler:
+    """ per-stage cProfile and tracemalloc for a run, see module docstring """
+
+    def __init__(self, directory, stages=STAGES):
+        """
+        :param directory: directory of the reports. Created if missing.
+        :param stages: names of the stages
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.profiles = {name: cProfile.Profile() for name in stages}
+        self.memory = {name: {'peak': 0, 'net': 0} for name in stages}
+        self.stacks = weakref.WeakKeyDictionary()  # {greenlet: stack of stage names}
+        self.slice_start = 0  # traced memory when the running stage was switched in
+        self.peak = 0
+        self.peak_snapshot = None
+        self.peak_snapshot_size = 0
+        self.previous_trace = None
+        self.sampler = None
+
+    def current_stage(self, glet):
+        stack = self.stacks.get(glet)
+        return stack[-1] if stack else None
+
+    def enter(self, name):
+        """ start profiling stage name (None: no stage) """
+        if name is None:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        self.peak = max(self.peak, peak)
+        tracemalloc.reset_peak()
+        self.slice_start = current
+        self.profiles[name].enable()
+
+    def leave(self, name):
+        """ stop profiling stage name (None: no stage) """
+        if name is None:
+            return
+        self.profiles[name].disable()
+        current, peak = tracemalloc.get_traced_memory()
+        self.memory[name]['peak'] = max(self.memory[name]['peak'], peak)
+        self.memory[name]['net'] += current - self.slice_start
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ context manager: the code of the block belongs to stage name. Stages can be nested. """
+        glet = greenlet.getcurrent()
+        stack = self.stacks.setdefault(glet, [])
+        self.leave(stack[-1] if stack else None)
+        stack.append(name)
+        self.enter(name)
+        try:
+            yield
+        finally:
+            stack.pop()
+            self.leave(name)
+            self.enter(stack[-1] if stack else None)
+
+    def switch(self, event, args):
+        """ greenlet trace function: move profiling from the greenlet switched out to the one switched in """
+        if event in ('switch', 'throw'):
+            origin, target = args
+            self.leave(self.current_stage(origin))
+            self.enter(self.current_stage(target))
+        if self.previous_trace:
+            self.previous_trace(event, args)
+
+    def sample_snapshots(self):
+        """ background greenlet: keep the tracemalloc snapshot of the moment with the most traced memory """
+        while True:
+            gevent.sleep(config.PROFILE_SNAPSHOT_INTERVAL)
+            self.take_snapshot()
+
+    def take_snapshot(self):
+        current, _ = tracemalloc.get_traced_memory()
+        if current > self.peak_snapshot_size:
+            self.peak_snapshot = tracemalloc.take_snapshot()
+            self.peak_snapshot_size = current
+
+    def start(self):
+        tracemalloc.start()  # a single frame per allocation: deeper tracebacks make the run much slower
+        self.previous_trace = greenlet.settrace(self.switch)
+        self.sampler = gevent.spawn(self.sample_snapshots)
+
+    def stop(self):
+        """ stop profiling and write the reports """
+        if self.sampler:
+            self.sampler.kill()
+        greenlet.settrace(self.previous_trace)
+        self.take_snapshot()
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        self.write_reports()
+        print(f'Profiling reports were written to {self.directory}.\n')
+
+    def write_reports(self):
+        for name, profile in self.profiles.items():
+            if not profile.getstats():
+                continue  # stage did not run
+            stats = pstats.Stats(profile)
+            stats.dump_stats(os.path.join(self.directory, f'{name}.prof'))
+            text = io.StringIO()
+            stats.stream = text
+            stats.strip_dirs()
+            text.write(f'stage: {name}\n\n*** top functions by total time (in the function itself) ***\n')
+            stats.sort_stats('tottime').print_stats(config.PROFILE_TOP)
+            text.write('*** top functions by cumulative time (including callees) ***\n')
+            stats.sort_stats('cumulative').print_stats(config.PROFILE_TOP)
+            with open(os.path.join(self.directory, f'{name}.txt'), 'w') as f:
+                f.write(text.getvalue())
+        with open(os.path.join(self.directory, 'memory.txt'), 'w') as f:
+            f.write(self.memory_report())
+
+    def memory_report(self):
+        """ return the memory report as text """
+        lines = [f'peak traced memory: {self.peak / 1024 ** 2:.1f} MiB',
+                 # ru_maxrss is in KiB on Linux
+                 f'peak resident set size: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB',
+                 '',
+                 f'{"stage":10} {"peak traced while running (MiB)":>32} {"net change while running (MiB)":>31}']
+        for name, memory in self.memory.items():
+            lines.append(f'{name:10} {memory["peak"] / 1024 ** 2:32.1f} {memory["net"] / 1024 ** 2:31.1f}')
+        if self.peak_snapshot:
+            lines += ['', f'top allocation sites at the highest traced memory '
+                          f'({self.peak_snapshot_size / 1024 ** 2:.1f} MiB):']
+            lines += self.top_sites(self.peak_snapshot)
+            for name, patterns in STAGE_FILES.items():
+                snapshot = self.peak_snapshot.filter_traces(
+                    [tracemalloc.Filter(True, pattern) for pattern in patterns])
+                lines += ['', f'stage {name}: top allocation sites of files {patterns}']
+                lines += self.top_sites(snapshot)
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def top_sites(snapshot):
+        return [f'{stat.size / 1024:10.1f} KiB {stat.count:8} blocks  {stat.traceback[0]}'
+                for stat in snapshot.statistics('lineno')[:config.PROFILE_TOP]]
+
+
+# the profiler of the run, or None if not profiling.
+active = None
+NO_STAGE = contextlib.nullcontext()
+
+
+def stage(name):
+    """ context manager: the code of the block belongs to stage name (no-op when not profiling) """
+    return active.stage(name) if active else NO_STAGE
+
+
+def start(directory):
+    """ start profiling the run, with reports written to directory by stop() """
+    global active
+    active = Profiler(directory)
+    active.start()
+
+
+def stop():
+    """ stop profiling and write the reports, if profiling """
+    global active
+    if active:
+        active.stop()
+        active = None
@@ -1,47 +1,166 @@
 """
 module to query data.gov.il's API and get demographic data per city/ishuv.
+The API (CKAN datastore_search) returns records by pages of `limit` records starting at `offset`,
+with the total number of records in each response. The first page tells the total,
+then the remaining pages are requested concurrently and yielded in order as they arrive,
+so that the records can be written to the database while the next pages are downloading.
+The last dataset written to the database is kept in a local snapshot file, with a content hash and the metadata
+of the resource (CKAN resource_show and record count), so that an unchanged resource is not downloaded again.
 This module defines functions to be used by realestatescraper.py, thus there is no main() function.
 """
 
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import urllib.parse
 
+import gevent.pool
 import requests
 
+import config
+from metrics import registry
 
-def get_records_next_url(url, domain):
+
+logger = logging.getLogger('scraper')
+
+# fields of the resource metadata (CKAN resource_show) that change when the resource is updated.
+RESOURCE_METADATA_FIELDS = ['last_modified', 'metadata_modified', 'size', 'hash']
+
+
+def get_page_url(url, offset, limit):
+    """ url of the page of limit records starting at offset, given the url of the API query """
+    return ''.join([url, '&offset=', str(offset), '&limit=', str(limit)])
+
+
+def get_page(session, url, offset, limit):
     """
-    The API returns records with a default batch size of 100.
-    In each record, it includes a link to the next batch.
-    This function, for a given url, queries the API and gets records
-    and the url to the next batch of records.
+    query the API for a page of records. The response is decoded once.
+    :param session: requests.Session, or the requests module
     :param url: url to query the API
-    :param domain: API domain
-    :return: a list of dictionaries (records) and he url to the next batch of records
+    :param offset: index of the first record of the page
+    :param limit: max number of records in the page
+    :return: tuple (list of dictionaries (records), total number of records of the query)
     """
-    r = requests.get(url)
-    records = r.json()['result']['records']
-    next_link = r.json()['result']['_links']['next']
-    next_url = ''.join([domain, next_link])
+    start = time.perf_counter()
+    r = session.get(get_page_url(url, offset, limit), timeout=config.REQUEST_TIMEOUT)
+    r.raise_for_status()
+    registry.observe('api_request_seconds', time.perf_counter() - start)
+    registry.inc('downloaded_bytes_total', len(r.content), level='api')
+    result = r.json()['result']
 
-    if records:
-        return records, next_url
-    else:
-        return None, None
+    return result['records'], result['total']
 
 
-def get_all_records(url, domain):
+def get_record_batches(url, limit=config.API_PAGE_SIZE, concurrency=config.API_CONCURRENCY):
     """
-    This function iteratively calls get_records_next_url() and stores records.
-    Stop iteration when we get no results, meaning that previous batch of records was the last one.
-    :param url: url to the first batch of results
-    :param domain: API domain
-    :return: list of dictionaries with all records for a given API query.
+    generator of the records for a given API query, by page, in the order of the API.
+    The first page gives the total number of records, the other pages are requested concurrently.
+    At most concurrency pages are downloaded ahead of the consumer, so memory is bounded by the page size.
+    :param url: url to query the API
+    :param limit: number of records per page
+    :param concurrency: max number of pages requested at the same time
+    :return: generator of lists of dictionaries (records)
     """
     print('loading data from API...')
-    all_records = []
-    next_url = url
-    while True:
-        records, next_url = get_records_next_url(next_url, domain)
-        if not records:
-            break
-        all_records.extend(records)
-    return all_records
+    session = requests.Session()
+    records, total = get_page(session, url, 0, limit)
+    registry.inc('api_records_total', len(records))
+    yield records
+    # pool.imap() yields the pages in the order of the offsets, whatever order they arrive in.
+    pool = gevent.pool.Pool(concurrency)
+    for records, _ in pool.imap(lambda offset: get_page(session, url, offset, limit), range(limit, total, limit),
+                                maxsize=concurrency):
+        registry.inc('api_records_total', len(records))
+        yield records
+    logger.info(f'API: {total} records.')
+
+
+def get_resource_metadata(url):
+    """
+    get the metadata of the resource queried by url, without downloading its records:
+    the fields of RESOURCE_METADATA_FIELDS from resource_show, and the number of records ('total').
+    :param url: url to query the API (datastore_search with resource_id)
+    :return: dictionary, or None if the metadata could not be read
+    """
+    parts = urllib.parse.urlsplit(url)
+    resource_id = urllib.parse.parse_qs(parts.query)['resource_id'][0]
+    show_url = f'{parts.scheme}://{parts.netloc}/api/3/action/resource_show?id={resource_id}'
+    try:
+        r = requests.get(show_url, timeout=config.REQUEST_TIMEOUT)
+        r.raise_for_status()
+        resource = r.json()['result']
+        _, total = get_page(requests, url, 0, 0)
+    except (requests.RequestException, ValueError, KeyError) as e:
+        logger.error(f'URL: {show_url} {repr(e)}')
+        return None
+    metadata = {field: resource.get(field) for field in RESOURCE_METADATA_FIELDS}
+    metadata['total'] = total
+
+    return metadata
+
+
+class Snapshot:
+    """
+    local copy of the last dataset written to the database, in a JSON lines file:
+    one line per page of records, then a header line with the content hash and the metadata.
+    Pages are added while they are written to the database, so the whole dataset is never held in memory.
+    The file is replaced atomically by commit(): an interrupted run leaves the previous snapshot.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the snapshot file
+        """
+        self.path = path
+        self.file = None
+        self.tmp_path = None
+        self.content_hash = None
+
+    def read_header(self):
+        """ return the header of the snapshot (dictionary), or None if there is no snapshot """
+        header = None
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    header = line
+            return json.loads(header) if header else None
+        except (OSError, ValueError):
+            return None
+
+    def read_pages(self):
+        """ generator of the pages of records of the snapshot """
+        with open(self.path, encoding='utf-8') as f:
+            lines = iter(f)
+            line = next(lines, None)
+            for next_line in lines:  # the last line is the header
+                yield json.loads(line)
+                line = next_line
+
+    def add_page(self, records):
+        """ add a page of records to the new snapshot, and to its content hash """
+        if self.file is None:
+            fd, self.tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.snapshot')
+            self.file = os.fdopen(fd, 'w', encoding='utf-8')
+            self.content_hash = hashlib.sha256()
+        line = json.dumps(records, ensure_ascii=False, sort_keys=True)
+        self.file.write(line + '\n')
+        self.content_hash.update(line.encode())
+
+    def commit(self, header):
+        """
+        write the header and replace the previous snapshot by the new one.
+        :param header: dictionary with the metadata. The content hash is added as 'content_hash'.
+        :return: the header written
+        """
+        if self.file is None:
+            self.add_page([])
+        header = dict(header, content_hash=self.content_hash.hexdigest())
+        self.file.write(json.dumps(header, ensure_ascii=False) + '\n')
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        self.file = None
+
+        return header
@@ -0,0 +1,116 @@
+"""
+module with the adaptive rate control of Real Estate scraper's fetch engine.
+Each host has a concurrency limit adjusted with additive-increase/multiplicative-decrease (AIMD), as in TCP:
+every successful response adds 1/limit to the limit (about +1 per round of requests), and a sign of congestion
+(throttling or server error status, timeout, connection error, very slow response) halves it.
+Failed requests are retried with jittered exponential backoff, and a Retry-After header pauses the host.
+The limit, latency and error rate of each host are exported in the metrics (see realestatescraper.scrape()).
+This module defines functions to be used by fetcher.py, thus there is no main() function.
+"""
+
+import collections
+import email.utils
+import random
+import time
+
+import gevent
+import gevent.event
+
+import config
+
+
+def backoff_delay(attempt):
+    """ seconds to wait before retry number attempt (1, 2...): exponential backoff with full jitter """
+    return random.uniform(0, min(config.BACKOFF_MAX, config.BACKOFF_BASE * 2 ** (attempt - 1)))
+
+
+def get_retry_after(r):
+    """ seconds asked by the server in the Retry-After header of response r (capped), or None """
+    value = r.headers.get('Retry-After') if r is not None else None
+    if not value:
+        return None
+    if value.strip().isdigit():
+        seconds = int(value)
+    else:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0), config.MAX_RETRY_AFTER)
+
+
+def is_retryable(r):
+    """ check if a request should be retried: no response (timeout, connection error) or a retryable status """
+    return r is None or r.status_code in config.RETRY_STATUSES
+
+
+class HostLimiter:
+    """
+    AIMD concurrency limit for the requests to a single host.
+    Usage: acquire() before sending a request, then release() with the outcome.
+    """
+
+    def __init__(self, max_limit):
+        """
+        :param max_limit: max number of requests in flight to the host (the limit starts there)
+        """
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        self.paused_until = 0
+        self.decreased_at = 0
+        self.latency = None  # exponentially weighted moving average of the successful response times
+        self.stats = {'requests': 0, 'errors': 0, 'retries': 0, 'decreases': 0}
+
+    @property
+    def error_rate(self):
+        """ share of the requests to the host that failed, were throttled or got a server error """
+        return self.stats['errors'] / max(self.stats['requests'], 1)
+
+    def acquire(self):
+        """ wait until a request to the host can be sent, return the time it is sent """
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                gevent.sleep(pause)
+            elif self.in_flight < int(self.limit):
+                break
+            else:
+                waiter = gevent.event.Event()
+                self.waiters.append(waiter)
+                waiter.wait()
+        self.in_flight += 1
+        self.stats['requests'] += 1
+
+        return time.monotonic()
+
+    def release(self, started, ok, retry_after=None):
+        """
+        report the outcome of a request and free its slot.
+        :param started: value returned by acquire()
+        :param ok: False if the request showed congestion: failed, was throttled or got a server error
+        :param retry_after: seconds asked by the server before the next request, or None
+        """
+        self.in_flight -= 1
+        latency = time.monotonic() - started
+        if ok and latency < config.SLOW_RESPONSE:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        else:
+            self.stats['errors'] += not ok
+            # react once per round of requests: requests sent before the last decrease saw the old limit.
+            if started > self.decreased_at:
+                self.limit = max(1.0, self.limit * config.AIMD_DECREASE)
+                self.decreased_at = time.monotonic()
+                self.stats['decreases'] += 1
+        if retry_after:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        self.wake()
+
+    def wake(self):
+        """ wake up as many waiting requests as there are free slots """
+        for _ in range(max(int(self.limit) - self.in_flight, 1)):
+            if not self.waiters:
+                break
+            self.waiters.popleft().set()
@@ -6,22 +6,40 @@ Module also queries data.gov.il API, gets demographics data and populate demogra
 """
 
 
-from bs4 import BeautifulSoup
-import grequests
-import requests
+# sockets and ssl must be patched before requests is imported, so that all network waits are cooperative.
+# os, signal and subprocess are left alone: the parse pool (parsepool.py) waits for its processes in a real thread.
+from gevent import monkey
+monkey.patch_all(thread=False, select=False, os=False, signal=False, subprocess=False)
+
+import gevent
+import gevent.event
+import gevent.pool
+import gevent.queue
 import logging
 import urllib.parse
-import json
+import ast
+import hashlib
 import re
 import unicodedata
 import itertools
 from datetime import date
+import time
 import argparse
-import configparser
 
 import config
 import updatedb
+import migratedb
 import queryapi
+import htmlparser
+import profiler
+from fetcher import FetchEngine
+from parsepool import ParsePool
+from httpcache import HTTPCache
+from agentlookup import AgentLookup, AgentStore
+from frontier import Frontier
+from adrecord import AdRecord, to_str, to_int, to_float
+from workqueue import WorkQueue, LEASED
+from metrics import registry, MetricsWriter
 
 
 # logger setup
@@ -50,7 +68,42 @@ def parse_args():
     parser.add_argument('-c', '--city', type=str, help='city name in English. e.g. Jerusalem')
     parser.add_argument('-t', '--tsize', default=config.DEFAULT_TSIZE, type=int,
                         help=f'transaction size: number of records per transaction in SQL DB')
+    parser.add_argument('--concurrency', default=config.DEFAULT_CONCURRENCY, type=int,
+                        help='max number of requests in flight while scraping')
+    parser.add_argument('--hostconcurrency', default=config.DEFAULT_HOST_CONCURRENCY, type=int,
+                        help='max number of requests in flight to the same host while scraping')
+    parser.add_argument('--parser', default=htmlparser.default_backend(), choices=htmlparser.available_backends(),
+                        help='HTML parser backend')
+    parser.add_argument('--parse-workers', default=0, type=int,
+                        help='number of worker processes that parse detailed ad pages. '
+                             'Default is 0: parse in the main process.')
+    parser.add_argument('--cache', metavar='DIR',
+                        help='keep downloaded pages in directory DIR and re-use them in the next runs. '
+                             'Pages are revalidated with the server once their TTL expires (see config.CACHE_TTL).')
+    parser.add_argument('--incremental', action='store_true',
+                        help='flag: download detailed ad pages only for new ads and for ads whose row in the '
+                             'result page changed since the last run. For the others, the last price is recorded.')
+    parser.add_argument('--resume', action='store_true',
+                        help='flag: continue the last crawl from where it stopped (crash or Ctrl-C), '
+                             'instead of starting a new one.')
+    parser.add_argument('--seed', metavar='QUEUE',
+                        help='split the crawl into city units in the shared work queue file QUEUE, '
+                             'to be crawled by --worker processes, instead of scraping.')
+    parser.add_argument('--worker', metavar='QUEUE',
+                        help='crawl the city units of the shared work queue file QUEUE (see --seed) '
+                             'until there are none left. --prop, --ad, --city and --resume are ignored.')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='write fetch, parse, database and queue metrics to file PATH every '
+                             f'{config.METRICS_INTERVAL} seconds: Prometheus text format if PATH ends with .prom, '
+                             'JSON otherwise.')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='profile the fetch, parse, database and API stages (CPU with cProfile, memory with '
+                             'tracemalloc) and write the reports to directory DIR at the end of the run. '
+                             'Slows the run.')
     parser.add_argument('--api', action='store_true', help='flag: download demographic data from API')
+    parser.add_argument('--force-api', action='store_true',
+                        help='flag: download demographic data from API and write it to the database, '
+                             'even if it did not change since the last run. Implies --api.')
     parser.add_argument('--onlyapi', action='store_true',
                         help='flag: only download demographic data from API and do not scrape.\n'
                              'All scraping-related params will be ignored.')
@@ -63,7 +116,7 @@ def check_args():
     """
     Check CLI arguments returned by parse_args().
     If any argument is invalid, print message and return None.
-    :return: property_types, ad_types, city_param, tsize, api, onlyapi
+    :return: property_types, ad_types, city_param, tsize, api, onlyapi, crawl_options
     property_type chosen by user in CLI or all config.PROPERTY_TYPES if no user param.
     ad_type chosen by user in CLI or all config.AD_TYPES if no user param.
     city_param chosen by user in CLI or None if no user param (in this case we'll scrape all cities).
@@ -71,6 +124,12 @@ def check_args():
     api is Boolean reflecting user decision to query demographics API or not. Default is False.
     onlyapi is Boolean reflecting user decision to **only** query demographics API or not.
     In this case all scraping-related params are ignored. Default is False.
+    crawl_options is a dictionary with scraping settings chosen by user in CLI or default values:
+    concurrency and host_concurrency of the fetch engine, parse_workers, parser backend,
+    cache directory (None if no cache), incremental (Boolean), resume (Boolean),
+    seed and worker: work queue file to fill or to crawl (None if not asked),
+    metrics file and profile directory (None if not asked, also used by the API stage),
+    force_api (Boolean): query demographics API even if the dataset did not change.
     """
     args = parse_args()
 
@@ -105,14 +164,35 @@ def check_args():
         print('The transaction size informed is not valid. Please try again.')
         return
     tsize = args.tsize
-    api = args.api
+    if args.concurrency < 1 or args.hostconcurrency < 1:
+        print('The concurrency informed is not valid. Please try again.')
+        return
+    if args.parse_workers < 0:
+        print('The number of parse workers informed is not valid. Please try again.')
+        return
+    if args.seed and args.worker:
+        print('Please choose either --seed or --worker.')
+        return
+    crawl_options = {'concurrency': args.concurrency,
+                     'host_concurrency': args.hostconcurrency,
+                     'parse_workers': args.parse_workers,
+                     'parser': args.parser,
+                     'cache': args.cache,
+                     'incremental': args.incremental,
+                     'resume': args.resume,
+                     'seed': args.seed,
+                     'worker': args.worker,
+                     'metrics': args.metrics,
+                     'profile': args.profile,
+                     'force_api': args.force_api}
+    api = args.api or args.force_api
     onlyapi = args.onlyapi
     if onlyapi:
         print('You chose to only query the API and not to scrape ads.\n'
               'In case you entered valid scraping-related parameters, they will be ignored.\n')
         api = True
 
-    return property_types, ad_types, city_param, tsize, api, onlyapi
+    return property_types, ad_types, city_param, tsize, api, onlyapi, crawl_options
 
 
 def get_quicklinks(property_types, ad_types):
@@ -135,37 +215,19 @@ def get_quicklinks(property_types, ad_types):
     return quicklinks
 
 
-def get_response(url):
-    """
-    send a GET request to the specified url using requests.
-    :param url: url
-    :return: Response object
-    """
-    r = requests.get(url)
-
-    return r
-
-
-def get_responses_grequests(urls):
-    """
-    send a GET request to the specified urls using grequests (asynchronously).
-    :param urls: url list
-    :return: list of Response objects
-    """
-    reqs = [grequests.get(url) for url in urls]
-    responses = grequests.map(reqs)
-
-    return responses
-
-
-def parse_response(r):
+def parse_response(r, page=None, backend=None):
     """
     parse (get soup object from) response object.
     :param r: response object
+    :param page: page type: 'quicklink', 'listing' or 'detail'. Quicklink and listing pages are parsed partially,
+                 keeping only the tags used by get_city_urls(), get_pages() and get_listing_rows().
+                 If None, parse the whole page. See htmlparser.PAGE_FILTERS
+    :param backend: parser backend. If None, htmlparser.default_backend(). See config.PARSER_BACKENDS
     :return: parsed soup object
     """
     html_doc = r.text
-    soup = BeautifulSoup(html_doc, "html.parser")
+    with registry.timer('parse_seconds', page=page or 'full'):
+        soup = htmlparser.make_soup(html_doc, page, backend)
 
     return soup
 
@@ -213,7 +275,7 @@ def get_pages(soup):
     :param soup: (parsed) first result page.
     :return: list of pages of a search result.
     """
-    pages = [elt.string for elt in soup.find_all('a', attrs={'class': 'paging'}) if elt.string.isnumeric()]
+    pages = [str(elt.string) for elt in soup.find_all('a', attrs={'class': 'paging'}) if elt.string.isnumeric()]
 
     return pages
 
@@ -238,17 +300,19 @@ def get_page_urls(city_url, pages, ad_type):
     return page_urls
 
 
-def get_ad_ids(soup):
+def get_listing_rows(soup):
     """
-    get the ad ids in a parsed page of search result.
-    Example: get the ids for all the ads in
-    https://www.komo.co.il/code/nadlan/apartments-for-rent.asp?nehes=1&cityName=%D7%91%D7%90%D7%A8+%D7%A9%D7%91%D7%A2
-    :return: list of ad ids in the page
+    get the ad ids in a parsed page of search result, with a hash of the summary row of each ad
+    (price, rooms, size, etc. as displayed in the result page).
+    The hash is stored in the database, so that --incremental crawls skip ads whose row did not change.
+    :return: dictionary {ad id: hash of the row text}, in page order
     """
-    ad_ids = [elt.get('id').split('modaaRowDv')[-1]
-              for elt in soup.find_all('div', attrs={'id': re.compile('modaaRowDv')})]
+    rows = {}
+    for elt in soup.find_all('div', attrs={'id': htmlparser.MODAAROW_ID}):
+        summary = ' '.join(elt.get_text(' ').split())
+        rows[elt.get('id').split('modaaRowDv')[-1]] = hashlib.sha1(summary.encode()).hexdigest()
 
-    return ad_ids
+    return rows
 
 
 def get_ad_url(ad_id):
@@ -264,177 +328,432 @@ def get_ad_url(ad_id):
     return ad_url
 
 
-def parse_detailed_ad_page(soup, ad_id, property_type, ad_type, today):
+NON_DIGITS = re.compile('[^0-9]')
+
+# declarative specs of the tags parse_ad_page() needs in a detailed ad page:
+# (field, tag name or None for any tag, attribute, value to match, keep all matches or only the first one).
+# value is a string that must be one of the attribute values, or a compiled regex searched in the attribute.
+# Boolean features, such as saferoom or balcony, are tags whose class is exactly "<feature> add".
+AD_PAGE_FIELDS = [('address_top', None, 'class', 'addressTop', False),
+                  ('address_bottom', 'div', 'class', 'addresBottom', False),
+                  ('price', None, 'class', re.compile('ModaaWDetailsValue'), False),
+                  ('first_info', 'div', 'class', 'firstInfo', True),
+                  ('description', 'div', 'id', 'teurWrap', False),
+                  ('floors_total', 'li', 'class', 'floorTotal', False),
+                  ('condo_fee', 'li', 'class', 'vaadBait', False),
+                  ('arnona', 'li', 'class', 'arnona', False),
+                  ('contact', 'div', 'class', re.compile('mefarsemNew'), False),
+                  ('contact_office', 'span', 'class', 'misradName', False)]
+# specs indexed for the single pass: {(attribute, value): [(field, tag name, keep all)]} for string values,
+# [(field, tag name, attribute, regex)] for regex values, {'<feature> add': feature} for boolean features.
+AD_PAGE_VALUE_SPECS = {}
+for _field, _name, _attribute, _value, _keep_all in AD_PAGE_FIELDS:
+    if isinstance(_value, str):
+        AD_PAGE_VALUE_SPECS.setdefault((_attribute, _value), []).append((_field, _name, _keep_all))
+AD_PAGE_REGEX_SPECS = [(_field, _name, _attribute, _value)
+                       for _field, _name, _attribute, _value, _keep_all in AD_PAGE_FIELDS
+                       if not isinstance(_value, str)]
+AD_PAGE_FEATURE_CLASSES = {f'{feature} add': feature for feature in config.BOOLEAN_FEATURES}
+
+
+def collect_ad_page_tags(soup):
+    """
+    walk a parsed detailed ad page once and collect the tags described in AD_PAGE_FIELDS.
+    Tags are matched as BeautifulSoup's find()/find_all() would match them, in document order.
+    :param soup: parsed ad page
+    :return: dictionary {field: tag} ({field: list of tags} for fields that keep all matches).
+             Boolean features found in the page are keys with value True.
     """
-    parse detailed ad page and get details.
+    tags = {}
+    for tag in soup.find_all(True):
+        for attribute in ('class', 'id'):
+            values = tag.get(attribute)
+            if not values:
+                continue
+            if isinstance(values, str):
+                values = [values]
+            for value in values:
+                for field, name, keep_all in AD_PAGE_VALUE_SPECS.get((attribute, value), ()):
+                    if name and tag.name != name:
+                        continue
+                    if keep_all:
+                        # identity check: Tag equality compares markup, and identical tags must all be kept.
+                        if not tags.setdefault(field, []) or tags[field][-1] is not tag:
+                            tags[field].append(tag)
+                    elif field not in tags:
+                        tags[field] = tag
+            joined = ' '.join(values)
+            for field, name, spec_attribute, regex in AD_PAGE_REGEX_SPECS:
+                if (spec_attribute == attribute and field not in tags
+                        and (not name or tag.name == name) and regex.search(joined)):
+                    tags[field] = tag
+            if attribute == 'class' and joined in AD_PAGE_FEATURE_CLASSES:
+                tags[AD_PAGE_FEATURE_CLASSES[joined]] = True
+
+    return tags
+
+
+def parse_ad_page(soup, ad_id, property_type, ad_type, today):
+    """
+    parse detailed ad page and get details, without network requests,
+    so that it can run in a parse worker process. See parse_ad_content().
+    Agent's name and phone are added later by agentlookup.AgentLookup.add_contact_details().
     :param soup: parsed ad page
     :param ad_id: ad id
     :param property_type: property_type of current search. See config.PROPERTY_TYPES
     :param ad_type: ad_type of current search. See config.AD_TYPES
     :param today: today date in iso format
-    :return: dictionary with ad details.
+    :return: AdRecord with ad details and (luachnum, modaanum) params for the agent phone API request,
+             or (None, None) if the ad is not active.
     """
-    details = {'ad_id': ad_id, 'property_type': property_type, 'ad_type': ad_type, 'date': today}
+    details = AdRecord(ad_id, property_type, ad_type, today)
+    # all the tags we need, collected in a single pass over the page. See AD_PAGE_FIELDS
+    tags = collect_ad_page_tags(soup)
 
     # get tag and string with address. If there is no address, register 'לא צוינה כתובת'
-    addresstop_tag = soup.find(attrs={'class': 'addressTop'})
+    addresstop_tag = tags.get('address_top')
     # the string comes with \xa0 instead of some spaces, so we need to normalize it.
     # Example: before normalization: 'דירה להשכרה,\xa0פרופ’ מחרז אברהם\xa04'
     #          after normalization: 'דירה להשכרה, פרופ’ מחרז אברהם 4'
     if addresstop_tag:
-        addresstop_fulltext = unicodedata.normalize("NFKD", addresstop_tag.find('span').string.strip())
-        details['address'] = (addresstop_fulltext.split(', ')[-1]
-                              if len(addresstop_fulltext.split(', ')) > 1
-                              else 'לא צוינה כתובת')
+        addresstop_parts = unicodedata.normalize("NFKD", addresstop_tag.find('span').string.strip()).split(', ')
+        details.address = addresstop_parts[-1] if len(addresstop_parts) > 1 else 'לא צוינה כתובת'
     else:
-        return  # if there is no addresstop_tag, the ad link is not active and there is no detailed info. Skip ad.
+        return None, None  # if there is no addresstop_tag, the ad link is not active and there is no detailed info.
 
     # get tag and string with neighborhood. If there is no neighborhood, register 'לא צוינה שכונה'
-    addresbottom_tag = soup.find('div', attrs={'class': 'addresBottom'})
+    addresbottom_tag = tags.get('address_bottom')
     if addresbottom_tag:
         addresbottom_fulltext = unicodedata.normalize("NFKD", addresbottom_tag.find('span').string.strip())
-        details['neighborhood'] = (addresbottom_fulltext.split(', ')[0]
-                                   if len(addresbottom_fulltext.split(', ')) > 1
-                                   else 'לא צוינה שכונה')
+        addresbottom_parts = addresbottom_fulltext.split(', ')
+        details.neighborhood = addresbottom_parts[0] if len(addresbottom_parts) > 1 else 'לא צוינה שכונה'
     else:
         addresbottom_fulltext = None
-        details['neighborhood'] = 'לא נשלף'
+        details.neighborhood = 'לא נשלף'
 
     # record city name as extracted from ad page.
     if addresbottom_fulltext:
-        city_name_in_website = addresbottom_fulltext.split(', ')[-1]
+        city_name_in_website = addresbottom_parts[-1]
         if "'" in city_name_in_website and '"' in city_name_in_website:
             # if there are both single and double quotes in city_name_in_website,
             # take out the single quote, as we will need to build string SQL query based on it.
-            details['city'] = city_name_in_website.replace("'", "")
+            details.city = city_name_in_website.replace("'", "")
         else:
-            details['city'] = city_name_in_website
+            details.city = city_name_in_website
     else:
-        details['city'] = 'לא נשלף'
+        details.city = 'לא נשלף'
 
-    # get price
-    if soup.find(attrs={'class': re.compile("ModaaWDetailsValue")}):
-        price_raw = soup.find(attrs={'class': re.compile("ModaaWDetailsValue")}).string
-    else:
-        price_raw = None
-    # exclude the shekel symbol and commas from the string.
+    # get price: exclude the shekel symbol and commas from the string.
     # ads with no price info have "לא צוין מחיר" in this field and map to None.
-    if price_raw:
-        if re.sub("[^0-9]", "", price_raw):
-            price = re.sub("[^0-9]", "", price_raw)
-        else:
-            price = None
-    else:
-        price = None
-    details['price'] = price
+    price_raw = tags['price'].string if 'price' in tags else None
+    details.price = to_int(NON_DIGITS.sub('', price_raw)) if price_raw else None
 
-    # get tag and strings with data on rooms, floor of the property, size in m2 and entry date.
-    firstinfo_tags = soup.find_all('div', attrs={'class': 'firstInfo'})
+    # get tags and strings with data on rooms, floor of the property, size in m2 and entry date.
+    firstinfo_tags = tags.get('first_info')
+    # without them, the fields are left as None.
     if firstinfo_tags:
         # rooms may be fractional, such as '2.5'
-        details['rooms'] = (firstinfo_tags[0].string.strip())
+        details.rooms = to_float(firstinfo_tags[0].string.strip())
         # floor is normally numeric, but may be "קרקע"
-        details['floor_property'] = (firstinfo_tags[1].string.strip())
-        details['size_m2'] = (firstinfo_tags[2].string.strip())
+        details.floor_property = firstinfo_tags[1].string.strip()
+        details.size_m2 = to_int(firstinfo_tags[2].string.strip())
         # entry dates may be a string like "גמיש" or an actual date.
-        details['entry_date'] = firstinfo_tags[3].string.strip() if len(firstinfo_tags) > 3 else None
-    else:
-        details['rooms'] = None
-        details['floor_property'] = None
-        details['size_m2'] = None
-        details['entry_date'] = None
+        details.entry_date = firstinfo_tags[3].string.strip() if len(firstinfo_tags) > 3 else None
 
     # get text description, total floors in building, condo fee and city property tax (arnona)
-    details['description'] = (soup.find('div', attrs={'id': 'teurWrap'}).string.strip()
-                              if soup.find('div', attrs={'id': 'teurWrap'})
-                              else None)
-    details['floors_total'] = (soup.find('li', attrs={'class': 'floorTotal'}).strong.string
-                               if soup.find('li', attrs={'class': 'floorTotal'})
-                               else None)
-    details['condo_fee'] = (re.sub("[^0-9]", "", soup.find('li', attrs={'class': 'vaadBait'}).strong.string)
-                            if soup.find('li', attrs={'class': 'vaadBait'})
-                            else None)
-    details['arnona'] = (re.sub("[^0-9]", "", soup.find('li', attrs={'class': 'arnona'}).strong.string)
-                         if soup.find('li', attrs={'class': 'arnona'})
-                         else None)
+    # the description is cut to the size of its column.
+    details.description = tags['description'].string.strip()[:1000] if 'description' in tags else None
+    details.floors_total = to_str(tags['floors_total'].strong.string) if 'floors_total' in tags else None
+    details.condo_fee = to_int(NON_DIGITS.sub('', tags['condo_fee'].strong.string)) if 'condo_fee' in tags else None
+    details.arnona = to_int(NON_DIGITS.sub('', tags['arnona'].strong.string)) if 'arnona' in tags else None
 
     # get values for boolean features, such as saferoom, balcony, etc.
     for feature in config.BOOLEAN_FEATURES:
-        if soup.find(attrs={'class': f'{feature} add'}):
-            details[feature] = True
-        else:
-            details[feature] = False
+        if feature in tags:
+            details.set_feature(feature)
 
     # get tag with contact type: private individual or real estate agent
-    contact_tag = soup.find('div', attrs={'class': re.compile("mefarsemNew")})
+    contact_tag = tags.get('contact')
     if contact_tag:
-        details['contact_type'] = contact_tag.string.strip()
+        details.contact_type = contact_tag.string.strip()
     else:
-        details['contact_type'] = 'מפרטי'  # contact assumed to be private individual if not extracted from tag
+        details.contact_type = 'מפרטי'  # contact assumed to be private individual if not extracted from tag
     # for real estate agents, get office name and website id
-    if soup.find('span', attrs={'class': 'misradName'}):
-        details['contact_office'] = soup.find('span', attrs={'class': 'misradName'}).string
-        details['contact_website_id'] = soup.find('span', attrs={'class': 'misradName'}).get('minisitenum')
+    if 'contact_office' in tags:
+        details.contact_office = to_str(tags['contact_office'].string)
+        details.contact_website_id = to_int(tags['contact_office'].get('minisitenum'))
     # luach number and modaa number are parameters for an API request to get real estate agent's phone.
     # modaa number should match ad id, but we extract here as is.
-    luachnum = eval(contact_tag['onclick'].split('ModaotActions.modaaWShowPhoneBottom')[1].split(';')[0])[0]
-    modaanum = eval(contact_tag['onclick'].split('ModaotActions.modaaWShowPhoneBottom')[1].split(';')[0])[1]
-
-    # to get real agent's email or private announcer phone or email, one must be logged in website's system.
-    # so that would be beyond the scope of this scraper.
-    # Thus, we get agent's name and phone alone (in case announcer is an agent)
-    if details['contact_type'] == 'מפרטי':
-        details['contact_name'] = None
-        details['contact_phone'] = None
-    elif details['contact_type'] == 'מתיווך':
-        # API request for agent's phone, equivalent to clicking on the 'phone' button on the ad site.
-        # agent phone and name are not displayed on the website.
-        # We must do a separate API request simulating a click.
-        agent_details = get_agent_details(luachnum, modaanum)  # API request for agent's phone
-        if agent_details['status'] == 'OK':
-            details['contact_name'] = agent_details['data']['name']
-            details['contact_phone'] = ''.join([agent_details['data']['phone1_pre'], agent_details['data']['phone1']])
-        else:
-            details['contact_name'] = None
-            details['contact_phone'] = None
+    # Example: "ModaotActions.modaaWShowPhoneBottom(1,3987676,'agent');return false;"
+    phone_args = ast.literal_eval(contact_tag['onclick'].split('ModaotActions.modaaWShowPhoneBottom')[1].split(';')[0])
+    luachnum, modaanum = phone_args[0], phone_args[1]
 
-    return details
+    return details, (luachnum, modaanum)
 
 
-def get_agent_details(luachnum, modaanum):
+def parse_ad_content(content, encoding, ad_id, property_type, ad_type, today, backend=None):
     """
-    get API response (JSON) for the contact details of an agent.
-    Take params luach number and modaa number (defined by website's API).
-    :param luachnum: param luach number
-    :param modaanum: param modaa number
-    :return: dictionary with agent_details
+    parse the raw content of a detailed ad page. Runs in a parse worker process (see parsepool.py),
+    so it takes bytes instead of a response object and returns picklable results.
+    Decoding is the same as requests' Response.text, so results are identical to the serial path.
+    :param content: raw response bytes
+    :param encoding: response encoding (Response.encoding, or apparent encoding if not informed by the server)
+    :param ad_id: ad id
+    :param property_type: property_type of current search. See config.PROPERTY_TYPES
+    :param ad_type: ad_type of current search. See config.AD_TYPES
+    :param today: today date in iso format
+    :param backend: parser backend. If None, htmlparser.default_backend(). See config.PARSER_BACKENDS
+    :return: same as parse_ad_page()
     """
-    url = ''.join(['https://www.komo.co.il/api/modaotActions/showPhone.api.asp', '?',
-                   'luachNum=', str(luachnum), '&', 'modaaNum=', str(modaanum)])
-    r = get_response(url)
-    agent_details = json.loads(r.text)
+    try:
+        html_doc = str(content, encoding, errors='replace')
+    except (LookupError, TypeError):
+        html_doc = str(content, errors='replace')
+    soup = htmlparser.make_soup(html_doc, 'detail', backend)
 
-    return agent_details
+    return parse_ad_page(soup, ad_id, property_type, ad_type, today)
 
 
-def scrape(property_types, ad_types, city_param, tsize):
+class Crawler:
+    """
+    Crawl state for a single scraping run.
+    Each method on_* is the callback of a crawl level: it parses a fetched page and submits the urls
+    of the next level to the fetch engine right away, so all three levels run in a pipeline.
     """
-    this function performs the scraping activity.
+
+    def __init__(self, engine, city_param, today, records, parse_pool=None, parser=None, incremental=False,
+                 agents=None, frontier=None):
+        """
+        :param engine: FetchEngine instance
+        :param city_param: city to scrape (if None, scrape all cities).
+        :param today: today date in iso format
+        :param records: bounded queue that receives the details dictionary of each parsed ad.
+        :param parse_pool: ParsePool instance to parse detailed ad pages, or None to parse in this process.
+        :param parser: parser backend. If None, htmlparser.default_backend(). See config.PARSER_BACKENDS
+        :param incremental: if True, skip detailed ad pages of ads whose result page row did not change
+                            since the last run (see check_listing_rows()).
+        :param agents: AgentLookup instance for agents' contact details. If None, one without persistent store.
+        :param frontier: Frontier instance recording the work units. If None, units are recorded in memory only.
+        """
+        self.engine = engine
+        self.parse_pool = parse_pool
+        self.parser = parser
+        self.city_param = city_param
+        self.today = today
+        self.records = records
+        self.incremental = incremental
+        self.unchanged = 0  # number of ads skipped by incremental mode
+        self.duplicates = 0  # number of ads skipped because they were already submitted in this crawl
+        self.agents = agents or AgentLookup(engine)
+        # parsed ads wait for agent details here, not in the fetch engine, so their fetch slots are released.
+        # When the pool is full, on_ad_page() waits for a free spot: backpressure on fetching.
+        self.agent_stage = gevent.pool.Pool(config.AGENT_CONCURRENCY)
+        self.frontier = frontier or Frontier(':memory:', today)
+        # worker mode: {url: (url of the work queue unit it descends from, kind, args, level)} of the pages submitted
+        # for the units being crawled, see crawl_work_queue(). None otherwise.
+        self.roots = None
+        self.running = {}  # {greenlet: url of the unit whose handler it runs}, to find the parent of submitted units
+        # handlers of the work unit kinds recorded in the frontier
+        self.handlers = {'quicklink': self.on_quicklink_page,
+                         'city': self.on_city_page,
+                         'listing': self.on_listing_page,
+                         'ad': self.on_ad_page}
+
+    def submit(self, url, kind, *args, level=1, root=None):
+        """
+        record a work unit in the frontier and submit it to the fetch engine, unless it is already done
+        (a resumed crawl may meet again pages done before it was interrupted).
+        :param url: url
+        :param kind: kind of page, key of self.handlers
+        :param args: extra arguments for the handler (JSON serializable)
+        :param level: crawl level of the url
+        :param root: worker mode: url of the work queue unit the page descends from.
+                     Default: the unit of the page whose handler submits it, else the url itself.
+        """
+        if self.frontier.is_done(url):
+            return
+        if self.roots is not None:
+            parent = self.running.get(gevent.getcurrent())
+            root = root or (self.roots[parent][0] if parent in self.roots else url)
+            self.roots[url] = (root, kind, args, level)
+        self.frontier.add(url, kind, args, level)
+        self.engine.submit(url, self.on_unit, kind, url, *args, level=level)
+
+    def on_unit(self, r, kind, url, *args):
+        """
+        callback of all work units: call the handler of the page, then record the unit as done.
+        Failed requests and handlers that raised are left unfinished, to be tried again by --resume.
+        Detailed ad pages are done when their ad is written to the database (see feed_db_streaming()).
+        With --profile, handlers are the parse stage (see profiler.py).
+        """
+        self.running[gevent.getcurrent()] = url
+        try:
+            with profiler.stage('parse'):
+                self.handlers[kind](r, *args)
+        finally:
+            del self.running[gevent.getcurrent()]
+        if r and kind != 'ad':
+            self.frontier.done([url])
+
+    def on_quicklink_page(self, r, property_type, ad_type, link):
+        """ 1st level: parse quicklink page and submit the first result page of each city """
+        if not r:
+            return
+        logger.info(f'URL: {link}')
+        soup = parse_response(r, 'quicklink', self.parser)
+
+        city_urls = get_city_urls(self.city_param, property_type, soup)  # dictionary {cityname: url}
+        if not city_urls:
+            if self.city_param:
+                print(f'The search for property type: {property_type}, ad type: {ad_type}, city: {self.city_param}\n'
+                      f'did not match any result page in the website.\n')
+            else:
+                print(f'The search for property type: {property_type}, ad type: {ad_type}\n'
+                      f'did not match any result page in the website.\n')
+            return
+
+        print(f'Scraping {len(city_urls)} city page(s) for '
+              f'{config.PROPERTY_TYPES[property_type], config.AD_TYPES[ad_type]}.\n'
+              f'Please wait...')
+        for cityname, city_url in city_urls.items():
+            self.submit(city_url, 'city', property_type, ad_type, cityname, city_url, level=2)
+
+    def on_city_page(self, r, property_type, ad_type, cityname, city_url):
+        """ 2nd level: parse the first result page of a city, submit remainder result pages and its ads """
+        if not r:
+            return
+        soup = parse_response(r, 'listing', self.parser)
+        # cityname reversed because name in Hebrew.
+        # In regular terminal, displays correctly. In PyCharm terminal, displays inverted. Did not find out why.
+        print(f'Loading data for city: {cityname[::-1]}')
+        logger.info(f'URL: {city_url}')
+        # get remainder result pages
+        pages = get_pages(soup)
+        page_urls = get_page_urls(city_url, pages, ad_type)  # list of urls for all pages of this city
+        n_pages = max([int(elt) for elt in pages]) if pages else 1
+        print(f'Number of result pages for the current search: {n_pages}.\n')
+
+        # ads of the first result page (already parsed) are submitted before remainder pages are fetched
+        self.submit_ads(soup, property_type, ad_type)
+        for page_url in page_urls:
+            self.submit(page_url, 'listing', property_type, ad_type, page_url, level=2)
+
+    def on_listing_page(self, r, property_type, ad_type, page_url):
+        """ 2nd level: parse a remainder result page (2nd on) and submit its ads """
+        if not r:
+            return
+        logger.info(f'URL: {page_url}')
+        self.submit_ads(parse_response(r, 'listing', self.parser), property_type, ad_type)
+
+    def submit_ads(self, soup, property_type, ad_type):
+        """
+        submit detailed ad pages for all ads in a parsed result page (in incremental mode, new or changed ads).
+        Ads already listed in another result page of the crawl are skipped: the first listing wins.
+        """
+        rows = get_listing_rows(soup)  # {ad_id: listing_hash}
+        new_rows = {ad_id: listing_hash for ad_id, listing_hash in rows.items() if self.frontier.seen.add(int(ad_id))}
+        self.duplicates += len(rows) - len(new_rows)
+        registry.inc('duplicate_ads_total', len(rows) - len(new_rows))
+        rows = new_rows
+        if self.incremental:
+            rows = self.check_listing_rows(rows)
+        for ad_id, listing_hash in rows.items():
+            self.submit(get_ad_url(ad_id), 'ad', ad_id, property_type, ad_type, listing_hash, level=3)
+
+    def check_listing_rows(self, rows):
+        """
+        incremental mode: check the ads of a result page against the database with a single query.
+        Ads already in the database with the same listing hash did not change since the last run:
+        their latest price is recorded again for today, and their detailed pages are not fetched.
+        :param rows: dictionary {ad_id: listing_hash} returned by get_listing_rows()
+        :return: dictionary {ad_id: listing_hash} of the new or changed ads
+        """
+        with profiler.stage('db'), updatedb.pool.connection() as connection:
+            prev_records = updatedb.get_properties_by_website_id([int(ad_id) for ad_id in rows], connection)
+            unchanged = [prev_records[int(ad_id)]['id'] for ad_id, listing_hash in rows.items()
+                         if int(ad_id) in prev_records and prev_records[int(ad_id)]['listing_hash'] == listing_hash]
+            if unchanged:
+                updatedb.insert_latest_prices(unchanged, self.today, connection)
+                connection.commit()
+        self.unchanged += len(unchanged)
+
+        return {ad_id: listing_hash for ad_id, listing_hash in rows.items()
+                if int(ad_id) not in prev_records or prev_records[int(ad_id)]['listing_hash'] != listing_hash}
+
+    def on_ad_page(self, r, ad_id, property_type, ad_type, listing_hash=None):
+        """ 3rd level: parse detailed ad page and hand details over to the database writer """
+        if not r:
+            return
+        try:
+            if self.parse_pool:
+                with registry.timer('parse_seconds', page='detail'):
+                    details, phone_params = self.parse_pool.apply(parse_ad_content, r.content,
+                                                                  r.encoding or r.apparent_encoding,
+                                                                  ad_id, property_type, ad_type, self.today,
+                                                                  self.parser)
+            else:
+                details, phone_params = parse_ad_page(parse_response(r, 'detail', self.parser),
+                                                      ad_id, property_type, ad_type, self.today)
+        except Exception as e:
+            logger.error(repr(e))
+            return
+        if details:
+            details.listing_hash = listing_hash
+            self.agent_stage.spawn(self.on_ad_details, details, phone_params)
+        else:
+            self.frontier.done([get_ad_url(ad_id)])  # inactive ad: nothing to write
+
+    def on_ad_details(self, details, phone_params):
+        """ agent stage: add contact details to a parsed ad (AdRecord) and hand it over to the database writer """
+        try:
+            self.agents.add_contact_details(details, *phone_params)
+        except Exception as e:
+            logger.error(repr(e))
+            return
+        # blocks while the queue is full, holding a spot in the agent stage: backpressure on fetching.
+        self.records.put(details)
+
+
+def scrape(property_types, ad_types, city_param, crawl_options, records, frontier=None, work_queue=None):
+    """
+    this function performs the scraping activity (see crawl()).
+    It is the producer stage of the scraping pipeline: the details dictionary of each parsed ad
+    is put in the records queue as soon as it is ready. StopIteration is put in the queue at the end,
+    also if the crawl failed, so that the database writer flushes the ads parsed so far.
+    Parameters are the ones of crawl().
+    """
+    killed = False
+    try:
+        crawl(property_types, ad_types, city_param, crawl_options, records, frontier, work_queue)
+    except gevent.GreenletExit:
+        killed = True
+        raise
+    finally:
+        # not if the crawl was killed because the writer stopped (see join_pipeline()): nobody reads the queue anymore.
+        if not killed:
+            records.put(StopIteration)
+
+
+def crawl(property_types, ad_types, city_param, crawl_options, records, frontier=None, work_queue=None):
+    """
+    crawl the website and put the details of each parsed ad in the records queue.
     :param property_types: property types to scrape.
     :param ad_types: advertisement types to scrape.
     :param city_param: city to scrape (if not provided, scrape all cities).
-    :return: dictionary of dictionaries {'ad_id': details_dictionary},
+    :param crawl_options: dictionary with crawl settings: concurrency, host_concurrency, parse_workers, parser, cache,
+                          incremental, resume.
+    :param records: bounded queue consumed by feed_db_streaming().
+    :param frontier: Frontier instance recording the work units of the crawl. If None, they are kept in memory only.
+    :param work_queue: WorkQueue instance. If given, this process is a worker: it crawls the city units of the queue
+                       instead of the quicklink pages (see crawl_work_queue()).
     """
     print('This is the Real Estate scraper.\n'
           'Running time may vary from a few minutes to dozens of minutes depending on the parameters provided.\n'
           'Scraping all the site for all possible property types, ad types and cities may take a few hours.\n')
 
-    # the date will be registered.
-    today = date.today().isoformat()
-
-    # the scraper will return a dictionary of dictionaries.
-    # Each nested dictionary has details of an ad. {'ad_id': details_dictionary}
-    details_dic = {}
+    # the date will be registered. A resumed crawl keeps the date of the interrupted one.
+    frontier = frontier or Frontier(':memory:', date.today().isoformat())
+    today = frontier.today
 
     # There are three levels of page results until we get the detailed page for a specific ad.
     # 1st level: the 'quicklinks webpage', with one link per city for a given (property_type, ad_type) pair.
@@ -446,187 +765,390 @@ def scrape(property_types, ad_types, city_param, tsize):
     #            Example: https://www.komo.co.il/code/nadlan/apartments-for-rent.asp?nehes=1&cityName=%D7%9C%D7%95%D7%93
     # 3rd level: detailed ad pages. There are up to 20 ad links per 2nd-level page.
     #            Example: https://www.komo.co.il/code/nadlan/details/?modaaNum=3865660
+    # The levels are pipelined: as soon as a page is parsed, the urls it links to are submitted to the fetch engine,
+    # which keeps up to crawl_options['concurrency'] requests in flight, deeper levels first.
+    # with --cache, pages are kept on disk and re-used or revalidated in the next runs.
+    cache = HTTPCache(crawl_options['cache']) if crawl_options['cache'] else None
+    engine = FetchEngine(crawl_options['concurrency'], crawl_options['host_concurrency'], cache)
+    # detailed ad pages are parsed in worker processes if the user asked for parse workers.
+    parse_pool = ParsePool(crawl_options['parse_workers']) if crawl_options['parse_workers'] else None
+    # agents' contact details are looked up once per agent: agents already in the contacts table are skipped,
+    # and the ones looked up in previous runs are kept in a local store (see agentlookup.py).
+    with updatedb.pool.connection() as connection:
+        updatedb.dimension_cache.load(connection)
+    agent_store = AgentStore()
+    crawler = Crawler(engine, city_param, today, records, parse_pool, crawl_options['parser'],
+                      crawl_options['incremental'], AgentLookup(engine, agent_store), frontier)
+    # queue depths, sampled when metrics are written: they show which stage is the bottleneck.
+    registry.gauge_function('records_queue', records.qsize)
+    registry.gauge_function('pending_units', lambda: len(engine.pending))
+    registry.gauge_function('active_units', lambda: engine.active)
+    registry.gauge_function('agent_stage', lambda: len(crawler.agent_stage))
+    registry.gauge_function('seen_set_bytes', lambda: frontier.seen.nbytes)
+    registry.gauge_function('host_limit', lambda: {(('host', host),): limiter.limit
+                                                   for host, limiter in engine.host_limiters.items()})
+    registry.gauge_function('host_latency_seconds', lambda: {(('host', host),): limiter.latency
+                                                             for host, limiter in engine.host_limiters.items()
+                                                             if limiter.latency is not None})
+    registry.gauge_function('host_error_rate', lambda: {(('host', host),): limiter.error_rate
+                                                        for host, limiter in engine.host_limiters.items()})
+
+    if work_queue:
+        crawl_work_queue(crawler, work_queue, records)
+    elif crawl_options['resume']:
+        # only the units that were not done when the previous crawl stopped
+        units = frontier.pending_units()
+        print(f'Resuming the crawl of {today}: {len(units)} unfinished page(s).\n')
+        for url, kind, args, level in units:
+            crawler.submit(url, kind, *args, level=level)
+    else:
+        quicklinks = get_quicklinks(property_types, ad_types)  # dictionary: {(property_type, ad_type): link}
+        for (property_type, ad_type), link in quicklinks.items():
+            crawler.submit(link, 'quicklink', property_type, ad_type, link, level=1)
+    engine.join()
+    crawler.agent_stage.join()
+    agent_store.close()
+    logger.info(f'Agent lookups: {crawler.agents.stats}')
+    for host, limiter in engine.host_limiters.items():
+        latency = f'{limiter.latency:.3f}s' if limiter.latency is not None else 'n/a'
+        logger.info(f'Host {host}: {limiter.stats}, latency {latency}, error rate {limiter.error_rate:.1%}, '
+                    f'limit {limiter.limit:.1f}')
+    if parse_pool:
+        parse_pool.close()
+    if cache:
+        logger.info(f'HTTP cache: {cache.stats}')
+    seen = frontier.seen
+    logger.info(f'Seen-set: {len(seen)} ads, {seen.nbytes} bytes ({seen.nbytes / max(len(seen), 1):.2f} bytes per ad), '
+                f'{crawler.duplicates} duplicate listings skipped.')
+    if crawler.duplicates:
+        print(f'{crawler.duplicates} ads were listed more than once: their detailed page was downloaded once.\n')
+    if crawler.incremental:
+        print(f'{crawler.unchanged} ads did not change since the last run: their price was recorded '
+              f'without downloading the detailed ad page.\n')
+
+
+def crawl_work_queue(crawler, work_queue, records):
+    """
+    worker mode: claim city units from the shared work queue a few at a time and crawl them, until there are none left.
+    A unit is complete when all the pages it led to are done: its result pages, and its ads are in the database.
+    Units with a page that failed (not fetched, or its handler raised) are given back to the queue, to be crawled
+    again: by another worker, or by this one, which then fetches only the pages that failed.
+    While other workers hold units, an idle worker waits for their leases to expire,
+    so that the units of a worker that died are crawled by the others.
+    :param crawler: Crawler instance
+    :param work_queue: WorkQueue instance
+    :param records: bounded queue consumed by feed_db_streaming()
+    """
+    crawler.roots = {}
+    retries = {}  # {unit url: [(url, kind, args, level)] of its pages that failed}, for units given back to the queue
+    work_queue.start()
+    while True:
+        units = work_queue.claim()
+        if not units:
+            if not work_queue.counts().get(LEASED):
+                break
+            gevent.sleep(config.WORKER_POLL)
+            continue
+        logger.info(f'Work queue: {work_queue.worker} claimed {[url for url, *_ in units]}')
+        for url, property_type, ad_type, cityname in units:
+            if url in retries:
+                for page_url, kind, args, level in retries.pop(url):
+                    crawler.submit(page_url, kind, *args, level=level, root=url)
+            else:
+                crawler.submit(url, 'city', property_type, ad_type, cityname, url, level=2)
+        crawler.engine.join()
+        crawler.agent_stage.join()
+        # ask the database writer to flush the ads of these units, and wait until it did.
+        flushed = gevent.event.Event()
+        records.put(flushed)
+        flushed.wait()
+        unfinished = {}  # {unit url: [(url, kind, args, level)] of its pages that are not done}
+        for url, (root, *unit) in crawler.roots.items():
+            if not crawler.frontier.is_done(url):
+                unfinished.setdefault(root, []).append((url, *unit))
+        crawler.roots.clear()
+        for url, pages in unfinished.items():
+            logger.warning(f'Work queue: unit {url} has {len(pages)} unfinished page(s), '
+                           f'giving it back to the queue: {[page[0] for page in pages[:5]]}')
+        retries.update(unfinished)
+        work_queue.complete([url for url, *_ in units if url not in unfinished])
+        work_queue.release([url for url, *_ in units if url in unfinished])
+    print(f'The work queue has no more units to crawl: {work_queue.counts()}\n')
+
+
+def seed_work_queue(property_types, ad_types, city_param, crawl_options):
+    """
+    fetch the quicklink pages and put one work unit per city page in the shared work queue (--seed).
+    The queue keeps today's date, so that all the workers record the same date.
+    :param property_types: property types to scrape.
+    :param ad_types: advertisement types to scrape.
+    :param city_param: city to scrape (if not provided, scrape all cities).
+    :param crawl_options: dictionary with crawl settings, see check_args()
+    """
+    cache = HTTPCache(crawl_options['cache']) if crawl_options['cache'] else None
+    engine = FetchEngine(crawl_options['concurrency'], crawl_options['host_concurrency'], cache)
+    units = []  # (city_url, property_type, ad_type, cityname)
 
-    quicklinks = get_quicklinks(property_types, ad_types)  # dictionary: {(property_type, ad_type): link}
-    for (property_type, ad_type), link in quicklinks.items():
-        logger.info(f'URL: {link}')
-        # 1st level
-        r = get_response(link)
+    def on_quicklink_page(r, property_type, ad_type, link):
         if not r:
-            continue
-        soup = parse_response(r)
+            logger.error(f'URL: {link} could not be fetched, its cities are not in the work queue.')
+            return
+        soup = parse_response(r, 'quicklink', crawl_options['parser'])
+        for cityname, city_url in get_city_urls(city_param, property_type, soup).items():
+            units.append((city_url, property_type, ad_type, cityname))
 
-        city_urls = get_city_urls(city_param, property_type, soup)  # dictionary {cityname: url}
-        if not city_urls:
-            if city_param:
-                print(f'The search for property type: {property_type}, ad type: {ad_type}, city: {city_param}\n'
-                      f'did not match any result page in the website.\n')
-            else:
-                print(f'The search for property type: {property_type}, ad type: {ad_type}\n'
-                      f'did not match any result page in the website.\n')
-            continue
-        city_urls_inv = {v: k for k, v in city_urls.items()}
+    for (property_type, ad_type), link in get_quicklinks(property_types, ad_types).items():
+        engine.submit(link, on_quicklink_page, property_type, ad_type, link, level=1)
+    engine.join()
+    work_queue = WorkQueue(crawl_options['seed'])
+    work_queue.seed(units, date.today().isoformat())
+    work_queue.close()
+    print(f'The work queue {crawl_options["seed"]} was seeded with {len(units)} city units.\n')
 
-        print(f'Scraping {len(city_urls)} city page(s) for '
-              f'{config.PROPERTY_TYPES[property_type], config.AD_TYPES[ad_type]}.\n'
-              f'Please wait...')
 
-        resps_cities = get_responses_grequests(city_urls.values())
-        if not resps_cities:
+def feed_db_streaming(records, tsize, frontier=None):
+    """
+    consumer stage of the scraping pipeline: take details dictionaries from the records queue
+    and feed the database with feed_db_after_scraping().
+    Records are buffered and flushed when the buffer reaches config.DEFAULT_SCRAPEDICSIZE records
+    or config.FLUSH_INTERVAL seconds passed since the last flush, whichever comes first.
+    Network waits of the database connection are cooperative, so scraping goes on while a flush runs.
+    :param records: bounded queue filled by scrape(), ended by StopIteration.
+                    A gevent.event.Event in the queue asks for a flush, and is set once the buffer is written.
+    :param tsize: transaction size (defined by user or default value)
+    :param frontier: Frontier instance of the crawl, where written ads are recorded as done. Can be None.
+    :return: total number of records written to the database
+    """
+    details_dic = {}
+    total = 0
+    deadline = time.monotonic() + config.FLUSH_INTERVAL
+    while True:
+        try:
+            details = records.get(timeout=max(deadline - time.monotonic(), 0))
+        except gevent.queue.Empty:
+            details = None
+        if details is StopIteration:
+            break
+        if isinstance(details, gevent.event.Event):
+            if details_dic:
+                total += flush_records(details_dic, tsize, frontier)
+                details_dic = {}
+            details.set()
             continue
-        resps_cities_dic = {resp: resp.url for resp in resps_cities}
-        soup_cities_dic = {parse_response(resp): resp for resp in resps_cities_dic.keys()}
-
-        for soup_city in soup_cities_dic.keys():
-            city_url = resps_cities_dic[soup_cities_dic[soup_city]]
-            cityname = city_urls_inv[city_url]
-            # cityname reversed because name in Hebrew.
-            # In regular terminal, displays correctly. In PyCharm terminal, displays inverted. Did not find out why.
-            print(f'Loading data for city: {cityname[::-1]}')
-            logger.info(f'URL: {city_url}')
-            # 2nd level
-            # get remainder result pages
-            pages = get_pages(soup_city)
-            page_urls = get_page_urls(city_url, pages, ad_type)  # list of urls for all pages of this city
-            n_pages = max([int(elt) for elt in pages]) if pages else 1
-            print(f'Number of result pages for the current search: {n_pages}.\n')
-
-            # get ad_ids for the first result page (already parsed)
-            ad_ids = get_ad_ids(soup_city)
-            # get ad_urls
-            ad_urls = {get_ad_url(ad_id): ad_id for ad_id in ad_ids}
-            # 3rd level, detailed ad pages with GREQUESTS (for the ads in the first 2nd level result page)
-            resps_ads_page1 = get_responses_grequests(ad_urls)
-            if not resps_ads_page1:
-                continue
-            resps_ads_page1_dic = {resp: resp.url for resp in resps_ads_page1}
-            soup_ads_page1_dic = {parse_response(resp): resp for resp in resps_ads_page1_dic.keys()}
-
-            # parse all detailed ad pages (for the ads in the first 2nd level result page)
-            for soup_ad_page1 in soup_ads_page1_dic.keys():
-                ad_id = ad_urls[resps_ads_page1_dic[soup_ads_page1_dic[soup_ad_page1]]]
-                try:
-                    details = parse_detailed_ad_page(soup_ad_page1, ad_id, property_type, ad_type, today)
-                except Exception as e:
-                    logger.error(repr(e))
-                    continue
-                if details:
-                    details_dic[ad_id] = details
-                    if len(details_dic) > config.DEFAULT_SCRAPEDICSIZE:
-                        feed_db_after_scraping(details_dic, tsize)
-                        print(f'The database was updated with {len(details_dic)} records obtained via scraping.\n')
-                        details_dic = {}
-
-            # scrape and parse all detailed ad pages for remainder 2nd level result pages (2nd on)
-            resps_pages = get_responses_grequests(page_urls)
-            if not resps_pages:
-                continue
-            resps_pages_dic = {resp: resp.url for resp in resps_pages}
-            soup_pages_dic = {parse_response(resp): resp for resp in resps_pages_dic.keys()}
-            for soup_pages in soup_pages_dic.keys():  # for page_url in page_urls:
-
-                logger.info(f'URL: {resps_pages_dic[soup_pages_dic[soup_pages]]}')
-                ad_ids = get_ad_ids(soup_pages)
-                # get ad_urls
-                ad_urls = {get_ad_url(ad_id): ad_id for ad_id in ad_ids}
-                # 3rd level, detailed ad pages with GREQUESTS (for ads in remainder 2nd level result pages)
-                resps_ads_otherpages = get_responses_grequests(ad_urls)
-                if not resps_ads_otherpages:
-                    continue
-                resps_ads_otherpages_dic = {resp: resp.url for resp in resps_ads_otherpages}
-                s_ads_otherpages_dic = {parse_response(resp): resp for resp in resps_ads_otherpages_dic.keys()}
-                # parse all detailed ad pages (for ads in remainder 2nd level result pages)
-                for s in s_ads_otherpages_dic.keys():
-                    ad_id = ad_urls[resps_ads_otherpages_dic[s_ads_otherpages_dic[s]]]
-                    try:
-                        details = parse_detailed_ad_page(s, ad_id, property_type, ad_type, today)
-                    except Exception as e:
-                        logger.error(repr(e))
-                        continue
-                    if details:
-                        details_dic[ad_id] = details
-                        if len(details_dic) > config.DEFAULT_SCRAPEDICSIZE:
-                            feed_db_after_scraping(details_dic, tsize)
-                            print(f'The database was updated with {len(details_dic)} records obtained via scraping.\n')
-                            details_dic = {}
+        if details:
+            details_dic[details.ad_id] = details
+        if len(details_dic) >= config.DEFAULT_SCRAPEDICSIZE or time.monotonic() >= deadline:
+            if details_dic:
+                total += flush_records(details_dic, tsize, frontier)
+                details_dic = {}
+            deadline = time.monotonic() + config.FLUSH_INTERVAL
+    if details_dic:
+        total += flush_records(details_dic, tsize, frontier)
 
-    return details_dic
+    return total
+
+
+def flush_records(details_dic, tsize, frontier=None):
+    """
+    write buffered scraping results to the database, then record their detailed ad pages as done in the frontier
+    and checkpoint it right away, so that a resumed crawl does not write them again.
+    :param details_dic: dictionary {ad_id: AdRecord} with scraping results
+    :param tsize: transaction size (defined by user or default value)
+    :param frontier: Frontier instance of the crawl, or None
+    :return: number of records written
+    """
+    with profiler.stage('db'):
+        feed_db_after_scraping(details_dic, tsize)
+    print(f'The database was updated with {len(details_dic)} records obtained via scraping.\n')
+    if frontier:
+        frontier.done([get_ad_url(ad_id) for ad_id in details_dic])
+        frontier.checkpoint()
+
+    return len(details_dic)
 
 
 def feed_db_after_scraping(details_dic, tsize):
     """
     Take a dictionary with scraping results, and feed the database,
     inserting new records or updating current records.
-    commit transactions according to transaction size.
-    :param details_dic: dictionary with scraping results
+    Ads are written in batches of tsize ads with multi-row statements (see updatedb.feed_ads()),
+    and each batch is committed as one transaction.
+    :param details_dic: dictionary {ad_id: AdRecord} with scraping results
     :param tsize: transaction size (defined by user or default value)
     """
     print(f'{len(details_dic)} ads were scraped.\n')
-    cred = configparser.ConfigParser()
-    cred.read('credentials.ini')
-    connection = updatedb.connect(cred)
-    updatedb.use_db(connection)
-
-    t = 0
-    for ad_id, result in details_dic.items():
-        if updatedb.query_db(f'SELECT id FROM properties WHERE website_id = {int(ad_id)}', connection):
-            t = updatedb.update_current_add(int(ad_id), result, connection, t)
-            if t > tsize:
+    with registry.timer('db_flush_seconds'), updatedb.pool.connection() as connection:
+        updatedb.dimension_cache.load(connection)
+        results = list(details_dic.values())
+        for i in range(0, len(results), tsize):
+            t = updatedb.feed_ads(results[i:i + tsize], connection)
+            with registry.timer('db_commit_seconds'):
                 connection.commit()
-                logger.info(f'Commited {t} transactions.')
-                t = 0
-        else:
-            t = updatedb.insert_new_ad(ad_id, result, connection, t)
-            if t > tsize:
-                connection.commit()
-                logger.info(f'Commited {t} transactions.')
-                t = 0
-    if t:
-        connection.commit()
-        logger.info(f'Commited {t} transactions.')
+            updatedb.dimension_cache.commit(connection)
+            logger.info(f'Commited {t} transactions.')
+    registry.inc('db_records_written_total', len(results), source='scraping')
 
-    connection.close()
 
+def join_pipeline(producer, consumer):
+    """
+    wait for the two stages of a pipeline connected by a bounded queue, and raise the exception of the one that failed.
+    The producer ends the queue with StopIteration also when it fails, so the consumer finishes its work first.
+    If the consumer fails, the producer is killed: it would wait forever for room in the queue.
+    :param producer: greenlet filling the queue
+    :param consumer: greenlet emptying the queue
+    """
+    consumer.join()
+    if consumer.successful():
+        producer.join()
+    else:
+        producer.kill()
+    for stage in (producer, consumer):
+        if not stage.successful():
+            raise stage.exception
 
-def query_api_feed_db(tsize):
+
+def query_api_feed_db(tsize, force=False):
     """
     query API, get relevant results and feed the database,
     inserting new records or updating current records.
-    commit transactions according to transaction size.
+    The download and the database writes run concurrently, connected by a bounded queue of record pages,
+    so the writes start with the first page and memory is bounded by config.API_QUEUESIZE pages.
+    The dataset written is kept in a local snapshot (config.API_SNAPSHOT) with the metadata of the resource:
+    - if the resource and the database did not change since, there is nothing to do.
+    - if only the cities table changed (new cities scraped), the snapshot is written again, without downloading.
     :param tsize: transaction size (defined by user or default value)
+    :param force: if True, download and write the dataset even if it did not change
+    :return: True if the dataset was written to the database, False if it was up to date
     """
-    t = 0
-    cred = configparser.ConfigParser()
-    cred.read('credentials.ini')
-    connection = updatedb.connect(cred)
-    updatedb.use_db(connection)
-    api_records = queryapi.get_all_records(config.API_URL, config.API_DOMAIN)
-    for record in api_records:
-        t = updatedb.update_or_insert_demographics(record, connection, t)
-        if t > tsize:
-            connection.commit()
-            logger.info(f'Commited {t} transactions.')
-            t = 0
-    if t:
-        connection.commit()
-        logger.info(f'Commited {t} transactions.')
-    connection.close()
+    snapshot = queryapi.Snapshot(config.API_SNAPSHOT)
+    header = snapshot.read_header()
+    metadata = queryapi.get_resource_metadata(config.API_URL)
+    with updatedb.pool.connection() as connection:
+        db_state = updatedb.get_demographics_state(connection)
+    source = None  # pages of records to write: None to download them
+    if header and metadata and header['metadata'] == metadata and not force:
+        if header['db_state'] == db_state:
+            return False
+        source = snapshot.read_pages()
+        print('The demographic data did not change since the last run: writing it again for the new cities.')
+
+    batches = gevent.queue.Queue(maxsize=config.API_QUEUESIZE)
+    writer = gevent.spawn(feed_db_api_streaming, batches, tsize)
+    download = gevent.spawn(download_api_records, batches, snapshot, source)
+    join_pipeline(download, writer)
+
+    with updatedb.pool.connection() as connection:
+        db_state = updatedb.get_demographics_state(connection)
+    new_header = snapshot.commit({'metadata': metadata, 'db_state': db_state})
+    if header and source is None and new_header['content_hash'] == header['content_hash']:
+        logger.info('API: the records did not change, only the resource metadata.')
+
+    return True
+
+
+def download_api_records(batches, snapshot, source=None):
+    """
+    producer stage of the API pipeline: put the pages of API records in the batches queue as they arrive,
+    and add them to the new snapshot of the dataset.
+    StopIteration is put in the queue at the end, also if the download failed, so that the writer finishes,
+    but not if the download was killed because the writer stopped (see join_pipeline()).
+    :param batches: bounded queue consumed by feed_db_api_streaming()
+    :param snapshot: queryapi.Snapshot instance
+    :param source: iterable of pages of records to write instead of downloading them, or None
+    """
+    killed = False
+    try:
+        with profiler.stage('api'):
+            for records in source or queryapi.get_record_batches(config.API_URL):
+                snapshot.add_page(records)
+                batches.put(records)  # blocks while the queue is full: backpressure on the download
+    except gevent.GreenletExit:
+        killed = True
+        raise
+    finally:
+        if not killed:
+            batches.put(StopIteration)
+
+
+def feed_db_api_streaming(batches, tsize):
+    """
+    consumer stage of the API pipeline: take pages of API records from the batches queue and feed the database,
+    inserting new records or updating current records.
+    Records are written in batches of tsize records with a multi-row statement
+    (see updatedb.bulk_upsert_demographics()), and each batch is committed as one transaction.
+    :param batches: bounded queue filled by download_api_records(), ended by StopIteration.
+    :param tsize: transaction size (defined by user or default value)
+    :return: dictionary with the number of demographics records 'inserted', 'changed' and 'unchanged'
+    """
+    counts = {'inserted': 0, 'changed': 0, 'unchanged': 0}
+    with profiler.stage('db'), updatedb.pool.connection() as connection:
+        for records in iter(batches.get, StopIteration):
+            for i in range(0, len(records), tsize):
+                batch_counts = updatedb.bulk_upsert_demographics(records[i:i + tsize], connection)
+                with registry.timer('db_commit_seconds'):
+                    connection.commit()
+                for k, v in batch_counts.items():
+                    counts[k] += v
+            registry.inc('db_records_written_total', len(records), source='api')
+    logger.info(f'Demographics: {counts}')
+    print(f'Demographics: {counts["inserted"]} cities inserted, {counts["changed"]} changed, '
+          f'{counts["unchanged"]} unchanged.')
+
+    return counts
 
 
 def main():
     check_args_result = check_args()
     if check_args_result:
-        property_types, ad_types, city_param, tsize, api, onlyapi = check_args_result
+        property_types, ad_types, city_param, tsize, api, onlyapi, crawl_options = check_args_result
     else:
         return
-    if not onlyapi:
-        details_dic = scrape(property_types, ad_types, city_param, tsize)
-        if details_dic:
-            feed_db_after_scraping(details_dic, tsize)
-            print(f'The database was updated with {len(details_dic)} records obtained via scraping.\n')
-    if api:
-        query_api_feed_db(tsize)
-        print('The database was updated with data from the API.')
+    with updatedb.pool.connection() as connection:
+        if not migratedb.is_up_to_date(connection):
+            print('The database schema is out of date. Please run migratedb.py first.')
+            return
+    work_queue = WorkQueue(crawl_options['worker']) if crawl_options['worker'] and not onlyapi else None
+    if work_queue and not work_queue.today:
+        print(f'The work queue {crawl_options["worker"]} was not seeded. Please run with --seed first.')
+        work_queue.close()
+        return
+    metrics_writer = MetricsWriter(crawl_options['metrics']) if crawl_options['metrics'] else None
+    if metrics_writer:
+        metrics_writer.start()
+    if crawl_options['profile']:
+        profiler.start(crawl_options['profile'])
+    try:
+        if not onlyapi and crawl_options['seed']:
+            seed_work_queue(property_types, ad_types, city_param, crawl_options)
+        elif not onlyapi:
+            if work_queue:
+                # a dead worker's units are crawled again by the others: the shared queue replaces the frontier file.
+                frontier = Frontier(':memory:', work_queue.today)
+            else:
+                # work units of the crawl and their status are checkpointed to disk, so that --resume can continue them.
+                frontier = Frontier(config.FRONTIER_PATH, date.today().isoformat(), crawl_options['resume'])
+                frontier.start()
+            # scraping and database writes run concurrently, connected by a bounded queue.
+            records = gevent.queue.Queue(maxsize=config.DEFAULT_QUEUESIZE)
+            try:
+                writer = gevent.spawn(feed_db_streaming, records, tsize, frontier)
+                scraping = gevent.spawn(scrape, property_types, ad_types, city_param, crawl_options, records, frontier,
+                                        work_queue)
+                join_pipeline(scraping, writer)
+            finally:
+                frontier.close()
+                if work_queue:
+                    work_queue.close()
+        if api:
+            if query_api_feed_db(tsize, crawl_options['force_api']):
+                print('The database was updated with data from the API.')
+            else:
+                print('The demographic data did not change since the last run: the database is up to date.')
+    finally:
+        profiler.stop()
+        if metrics_writer:
+            metrics_writer.stop()
+        updatedb.pool.close()
 
 
 if __name__ == '__main__':
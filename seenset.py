@@ -0,0 +1,74 @@
+"""
+module with the seen-set of Real Estate scraper: the ad ids (modaaNum) already submitted in a crawl.
+The same ad can be listed under several quicklinks and result pages. Its detailed page is fetched once:
+the crawler checks the seen-set before submitting it.
+Ad ids are integers, mostly in a narrow range, so the set is a bitmap of one bit per id. The bitmap is split in blocks
+of BLOCK_BITS ids, allocated when an id of the block is added, so that a few ids far from the others cost one block
+each instead of a bitmap over the whole range. For a typical crawl, this is a few bytes per ad, against ~100 bytes
+per ad for a Python set of strings. The set is saved with the frontier (see frontier.py), compressed, for --resume.
+This module defines functions to be used by the other modules, thus there is no main() function.
+"""
+
+import struct
+import zlib
+
+
+BLOCK_BITS = 4096
+BLOCK_BYTES = BLOCK_BITS // 8
+COUNT = struct.Struct('>Q')
+BLOCK_KEY = struct.Struct('>Q')
+
+
+class SeenSet:
+    """ set of non-negative integers, stored as a bitmap in blocks of BLOCK_BITS integers """
+
+    def __init__(self):
+        self.blocks = {}  # {n // BLOCK_BITS: bytearray of BLOCK_BYTES}
+        self.count = 0
+
+    def add(self, n):
+        """ add integer n to the set. :return: True if n was not in the set yet """
+        key, offset = divmod(n, BLOCK_BITS)
+        block = self.blocks.get(key)
+        if block is None:
+            block = self.blocks[key] = bytearray(BLOCK_BYTES)
+        byte, bit = divmod(offset, 8)
+        mask = 1 << bit
+        if block[byte] & mask:
+            return False
+        block[byte] |= mask
+        self.count += 1
+
+        return True
+
+    def __contains__(self, n):
+        key, offset = divmod(n, BLOCK_BITS)
+        block = self.blocks.get(key)
+        return block is not None and bool(block[offset // 8] & (1 << offset % 8))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        """ size of the bitmap blocks in bytes """
+        return len(self.blocks) * BLOCK_BYTES
+
+    def to_bytes(self):
+        """ return the compressed form of the set """
+        data = [COUNT.pack(self.count)]
+        for key, block in self.blocks.items():
+            data += [BLOCK_KEY.pack(key), block]
+        return zlib.compress(b''.join(data))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ return the set saved by to_bytes() """
+        data = zlib.decompress(data)
+        seen = cls()
+        seen.count, = COUNT.unpack_from(data)
+        for i in range(COUNT.size, len(data), BLOCK_KEY.size + BLOCK_BYTES):
+            key, = BLOCK_KEY.unpack_from(data, i)
+            seen.blocks[key] = bytearray(data[i + BLOCK_KEY.size:i + BLOCK_KEY.size + BLOCK_BYTES])
+
+        return seen
@@ -3,17 +3,37 @@ module to update Mysql database for Real Estate scraper project, given a list of
 This module defines functions to be used by realestatescraper.py, thus there is no main() function.
 """
 
+import configparser
+import contextlib
+import time
+
+import gevent.lock
 import pymysql.cursors
 
 import config
+from metrics import registry
+
 
+class CountingCursor(pymysql.cursors.DictCursor):
+    """
+    DictCursor that records every statement sent to the server in the metrics (see metrics.py):
+    round trips and their latency. executemany() sends its multi-row statements through execute().
+    """
 
-def connect(cred):
-    """ establish connection, reading from credentials """
+    def execute(self, query, args=None):
+        registry.inc('db_round_trips_total')
+        with registry.timer('db_query_seconds'):
+            return super().execute(query, args)
+
+
+def connect(cred, database=None):
+    """ establish connection, reading from credentials.
+    If database is given, it is used by the connection (and again after a reconnect). """
     connection = pymysql.connect(host=cred['DB']['host'],
                                  user=cred['DB']['user'],
                                  password=cred['DB']['password'],
-                                 cursorclass=pymysql.cursors.DictCursor)
+                                 database=database,
+                                 cursorclass=CountingCursor)
     return connection
 
 
@@ -34,111 +54,206 @@ def query_db(sql, connection):
         return res
 
 
+class ConnectionPool:
+    """
+    Pool of connections to the project database, shared by the scraping writer and the API loader.
+    credentials.ini is read once, connections are opened on demand (up to `size` at a time)
+    and kept open between uses instead of being opened and closed for every flush.
+    A connection that was idle for more than config.DB_PING_INTERVAL seconds is pinged when it is taken,
+    and reconnected if the server closed it in the meantime (e.g. after wait_timeout).
+    Waiting for a free connection blocks only the current greenlet.
+    """
+
+    def __init__(self, size=config.DB_POOL_SIZE, credentials='credentials.ini'):
+        """
+        :param size: max number of connections in use at the same time
+        :param credentials: path of the credentials file (see README)
+        """
+        self.size = size
+        self.credentials = credentials
+        self.cred = None
+        self.idle = []  # [(connection, time it was returned)]
+        self.slots = gevent.lock.BoundedSemaphore(size)
+
+    def new_connection(self):
+        """ open a new connection to the project database """
+        if self.cred is None:
+            self.cred = configparser.ConfigParser()
+            self.cred.read(self.credentials)
+        return connect(self.cred, config.DB_NAME)
+
+    def get(self):
+        """ take a connection from the pool, waiting if all `size` connections are in use """
+        self.slots.acquire()
+        try:
+            if not self.idle:
+                return self.new_connection()
+            connection, returned = self.idle.pop()
+            if time.monotonic() - returned > config.DB_PING_INTERVAL:
+                connection.ping(reconnect=True)
+            return connection
+        except Exception:
+            self.slots.release()
+            raise
+
+    def put(self, connection, broken=False):
+        """ give a connection back to the pool. Broken (or closed) connections are dropped.
+        The open transaction is rolled back first: under REPEATABLE READ even a read-only block leaves one open,
+        and an idle connection would keep its snapshot (and the undo history it needs on the server). """
+        if not broken and connection.open:
+            try:
+                connection.rollback()
+            except pymysql.err.Error:
+                broken = True
+        dimension_cache.rollback(connection)
+        if broken or not connection.open:
+            with contextlib.suppress(Exception):
+                connection.close()
+        else:
+            self.idle.append((connection, time.monotonic()))
+        self.slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        context manager giving a pooled connection. Changes not committed by the block are rolled back
+        when the connection is given back (see put()), and a connection that failed at the network level
+        is not reused.
+        """
+        connection = self.get()
+        broken = False
+        try:
+            yield connection
+        except (pymysql.err.OperationalError, pymysql.err.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.put(connection, broken)
+
+    def close(self):
+        """ close idle connections """
+        while self.idle:
+            connection, _ = self.idle.pop()
+            with contextlib.suppress(Exception):
+                connection.close()
+
+
+# one pool per process.
+pool = ConnectionPool()
+
+
 def insert_contact(data, connection):
-    """ insert record to contacts table """
+    """ insert record to contacts table, return id of the new record.
+    If a contact with the same website_id is already there (unique key, see migratedb.py), return its id instead."""
     with connection.cursor() as cursor:
         sql = 'INSERT INTO contacts ' \
               '(website_id, contact_type, office, name, phone) ' \
-              'VALUES (%s, %s, %s, %s, %s);'
+              'VALUES (%s, %s, %s, %s, %s) ' \
+              'ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id);'
         cursor.execute(sql, data)
+        return cursor.lastrowid
 
 
 def insert_city(data, connection):
     """ insert record to cities table. Only Hebrew name is inserted, as there is no English name in the website.
     96 city names were translated ex ante so that the user can use a --city CLI param to limit the search.
-    If the scraper finds new records for city names, they are normally small settlements/kibbutzim."""
+    If the scraper finds new records for city names, they are normally small settlements/kibbutzim.
+    Return id of the new record, or of the existing one if the name is already there (unique key, see migratedb.py)."""
     with connection.cursor() as cursor:
         sql = 'INSERT INTO ' \
               'cities (name_heb) ' \
-              'VALUES (%s);'
+              'VALUES (%s) ' \
+              'ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id);'
         cursor.execute(sql, data)
+        return cursor.lastrowid
 
 
-def insert_property(data, connection):
-    """ insert record to properties table """
-    with connection.cursor() as cursor:
-        sql = 'INSERT INTO properties ' \
-              '(website_id, property_type_id, ad_type_id, city_id, contact_id) ' \
-              'VALUES (%s, %s, %s, %s, %s);'
-        cursor.execute(sql, data)
-
-
-def insert_property_details(data, connection):
-    """ insert record to property_details table """
-    with connection.cursor() as cursor:
-        sql = 'INSERT INTO property_details ' \
-              '(property_id, address, neighborhood, rooms, ' \
-              'size_m2, floor_property, floors_in_building, ' \
-              'description, entry_date, condo_fee, arnona, safe_room,' \
-              ' balcony, storeroom, security_bars, air_conditioning, furniture,' \
-              'accessibility, elevator, parking, roommates, pets, sun_boiler) ' \
-              'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, ' \
-              '%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);'
-        cursor.execute(sql, data)
+def get_website_id_map(table, connection):
+    """ take a small lookup table with website_id and id columns (property_types, ad_types),
+    return dictionary {website_id: id} """
+    return {row['website_id']: row['id'] for row in query_db(f'SELECT id, website_id FROM {table}', connection)}
 
 
-def insert_price(data, connection):
-    """ insert record to prices table """
-    with connection.cursor() as cursor:
-        sql = 'INSERT INTO prices ' \
-              '(property_id, date, price) ' \
-              'VALUES (%s, %s, %s);'
-        cursor.execute(sql, data)
-
-
-def update_property(website_id, updates, connection):
-    """ update record in properties table.
-    Use case example: property was announced as 'regular_apartment' and ad was corrected to 'penthouse' """
-    with connection.cursor() as cursor:
-        sql_head = 'UPDATE properties SET '
-        sql_middle = ','.join([f'{column} = {value}' for column, value in updates.items()])
-        sql_tail = f' WHERE website_id = {website_id}'
-        sql = ''.join([sql_head, sql_middle, sql_tail]).replace('None', 'NULL')  # None must be replaced by NULL
-        cursor.execute(sql)
-
-
-def update_property_details(property_id, updates, connection):
-    """ update record in properties table.
-    Use case example: property details were edited, description was corrected, etc.
-    Strings such as fields 'address' or 'entry_date' may contain (single or double) quotes,
-    and numerical values are not surrounded by quotes in the SQL query,
-    so we have to treat them separately.
+class DimensionCache:
+    """
+    In-process cache of the small lookup tables: cities, contacts, property_types and ad_types.
+    They are loaded once per process with one query per table (see load()),
+    and new cities and contacts are written through the cache, taking their ids from cursor.lastrowid,
+    so that getting foreign keys for an ad does not need a round trip to the database.
+    Other processes (--worker) may insert the same city or contact at the same time: the insert then returns the id
+    of the record already there (see insert_city() and insert_contact()), so the cache agrees with the database.
+    Records inserted in a transaction that is rolled back are forgotten (see rollback()).
     """
-    with connection.cursor() as cursor:
-        sql_head = 'UPDATE property_details SET '
-
-        sql_middle_l1 = [f"""{column} = '{value}' """ for column, value in updates.items()
-                         if (isinstance(value, str) and ('"' in value))]
-        sql_middle_l2 = [f"""{column} = "{value}" """ for column, value in updates.items()
-                         if (isinstance(value, str) and ('"' not in value))]
-        sql_middle_l3 = [f"""{column} = {value} """ for column, value in updates.items()
-                         if not isinstance(value, str)]
-        sql_middle = ','.join(sql_middle_l1 + sql_middle_l2 + sql_middle_l3)
-
-        sql_tail = f' WHERE property_id = {property_id}'
-        sql = ''.join([sql_head, sql_middle, sql_tail]).replace('None', 'NULL')  # None must be replaced by NULL
-
-        cursor.execute(sql)
-
-
-def update_demographics(city_id, updates, connection):
-    """ update record in demographics table.
-    Use case example: data on API server were updated since last time that user got API data. """
-    with connection.cursor() as cursor:
-        sql_head = 'UPDATE demographics SET '
-        sql_middle = ','.join([f'{column} = {value}' for column, value in updates.items()])
-        sql_tail = f' WHERE city_id = {city_id}'
-        sql = ''.join([sql_head, sql_middle, sql_tail]).replace('None', 'NULL')  # None must be replaced by NULL
-        cursor.execute(sql)
-
 
-def insert_demographics(data, connection):
-    """ insert record to prices table """
-    with connection.cursor() as cursor:
-        sql = 'INSERT INTO demographics ' \
-              '(city_id, total_pop, age_0_5, age_6_18, age_19_45, age_46_55, age_56_64, age_65_plus) ' \
-              'VALUES (%s, %s, %s, %s, %s, %s, %s, %s);'
-        cursor.execute(sql, data)
+    def __init__(self):
+        self.loaded = False
+        self.cities = {}  # {name_heb: id}
+        self.contacts = {}  # {website_id: id}, real estate agents
+        self.private_contact_id = None  # the one preloaded record for private individuals
+        self.property_types = {}  # {website_id: id}
+        self.ad_types = {}  # {website_id: id}
+        self.uncommitted = {}  # {connection: [(cities or contacts, key)] inserted in its open transaction}
+
+    def load(self, connection):
+        """ load lookup tables from the database, if not loaded yet """
+        if self.loaded:
+            return
+        for row in query_db('SELECT id, name_heb FROM cities ORDER BY id', connection):
+            self.cities.setdefault(row['name_heb'], row['id'])
+        for row in query_db('SELECT id, website_id FROM contacts WHERE website_id IS NOT NULL ORDER BY id',
+                            connection):
+            self.contacts.setdefault(row['website_id'], row['id'])
+        private = query_db('SELECT id FROM contacts WHERE contact_type = "מפרטי" ORDER BY id LIMIT 1', connection)
+        self.private_contact_id = private[0]['id'] if private else None
+        self.property_types = get_website_id_map('property_types', connection)
+        self.ad_types = get_website_id_map('ad_types', connection)
+        self.loaded = True
+
+    def get_city_id(self, city_name, connection):
+        """ get id of city_name, inserting it into cities table if new. Return id, True if inserted """
+        self.load(connection)
+        if city_name in self.cities:
+            return self.cities[city_name], False
+        self.cities[city_name] = insert_city(city_name, connection)
+        self.uncommitted.setdefault(connection, []).append((self.cities, city_name))
+        return self.cities[city_name], True
+
+    def get_contact_id(self, result, connection):
+        """ get id of the contact of an ad, inserting agent into contacts table if new. Return id, True if inserted """
+        self.load(connection)
+        if result.contact_type != 'מתיווך':
+            return self.private_contact_id, False
+        website_id = result.contact_website_id
+        if website_id in self.contacts:
+            return self.contacts[website_id], False
+        data = (website_id, result.contact_type, result.contact_office, result.contact_name, result.contact_phone)
+        self.contacts[website_id] = insert_contact(data, connection)
+        self.uncommitted.setdefault(connection, []).append((self.contacts, website_id))
+        return self.contacts[website_id], True
+
+    def commit(self, connection):
+        """ keep the cities and contacts inserted by connection: call after committing its transaction """
+        self.uncommitted.pop(connection, None)
+
+    def rollback(self, connection):
+        """ forget the cities and contacts inserted by connection since its last commit: their ids were
+        rolled back with the transaction, and may be given to other records. Called by ConnectionPool.put() """
+        for table, key in self.uncommitted.pop(connection, []):
+            table.pop(key, None)
+
+    def get_property_type_id(self, website_id, connection):
+        """ get id of a property type, given its website id. See config.PROPERTY_TYPES """
+        self.load(connection)
+        return self.property_types[website_id]
+
+    def get_ad_type_id(self, website_id, connection):
+        """ get id of an ad type, given its website id. See config.AD_TYPES """
+        self.load(connection)
+        return self.ad_types[website_id]
+
+
+# one cache per process, shared by all connections.
+dimension_cache = DimensionCache()
 
 
 def get_contact_id_foreign_key(result, connection, t):
@@ -147,23 +262,14 @@ def get_contact_id_foreign_key(result, connection, t):
     if announcer is real estate agent, check if she is in contacts table. If not, insert.
     if announcer is private individual, we do not have access to details,
     so there is one preloaded record in contacts table.
-    :param result: dictionary with the scraping result for a single ad
+    :param result: AdRecord with the scraping result for a single ad
     :param connection: connection instance
     :param t: current transaction count
     :return: contact_id, updated t
     """
-
-    if result['contact_type'] == 'מתיווך':
-        if not query_db(f'SELECT id FROM contacts WHERE website_id = {result["contact_website_id"]}', connection):
-            data = (result["contact_website_id"], result["contact_type"],
-                    result["contact_office"], result["contact_name"], result["contact_phone"])
-            insert_contact(data, connection)
-            t += 1
-        contact_id = query_db(f'SELECT id FROM contacts WHERE website_id = '
-                              f'{result["contact_website_id"]}', connection)[0]['id']
-    else:
-
-        contact_id = query_db(f'SELECT id FROM contacts WHERE contact_type = "מפרטי" ', connection)[0]['id']
+    contact_id, inserted = dimension_cache.get_contact_id(result, connection)
+    if inserted:
+        t += 1
 
     return contact_id, t
 
@@ -172,238 +278,325 @@ def get_city_id_foreign_key(result, connection, t):
     """
     get city id foreign key.
     If city not in cities table, insert.
-    :param result: dictionary with the scraping result for a single ad
+    :param result: AdRecord with the scraping result for a single ad
     :param connection: connection instance
     :param t: current transaction count
     :return: city_id, updated t
     """
-    city_name = result["city"]
-    # deal with quotes in city_name so that the string SQL query does not crash
-    if '"' in city_name:
-        sql = f"""SELECT * FROM cities WHERE name_heb = '{city_name}' """
-    else:
-        sql = f"""SELECT * FROM cities WHERE name_heb = "{city_name}" """
-
-    if not query_db(sql, connection):
-        insert_city(city_name, connection)
+    city_id, inserted = dimension_cache.get_city_id(result.city, connection)
+    if inserted:
         t += 1
-    city_id = query_db(sql, connection)[0]['id']
 
     return city_id, t
 
 
-def insert_new_ad(ad_id, result, connection, t):
+# columns of property_details that feed_ads() compares with the scraping results, in table order.
+PROPERTY_DETAILS_COLUMNS = ['address', 'neighborhood', 'rooms', 'size_m2', 'floor_property', 'floors_in_building',
+                            'description', 'entry_date', 'condo_fee', 'arnona', 'safe_room', 'balcony', 'storeroom',
+                            'security_bars', 'air_conditioning', 'furniture', 'accessibility', 'elevator', 'parking',
+                            'roommates', 'pets', 'sun_boiler']
+
+
+def get_properties_by_website_id(website_ids, connection):
+    """ take list of website ids, return dictionary {website_id: properties record} for those in the database,
+    with a single query """
+    if not website_ids:
+        return {}
+    with connection.cursor() as cursor:
+        sql = f'SELECT * FROM properties WHERE website_id IN ({", ".join(["%s"] * len(website_ids))});'
+        cursor.execute(sql, website_ids)
+        return {row['website_id']: row for row in cursor.fetchall()}
+
+
+def get_current_ads(website_ids, connection):
+    """ take list of website ids, return dictionary {website_id: record} for those in the database,
+    where record has the columns of both properties and property_details, with a single joined query.
+    property_id is None if the property has no property_details record. """
+    if not website_ids:
+        return {}
+    with connection.cursor() as cursor:
+        sql = 'SELECT p.*, d.* FROM properties p ' \
+              'LEFT JOIN property_details d ON d.property_id = p.id ' \
+              f'WHERE p.website_id IN ({", ".join(["%s"] * len(website_ids))});'
+        cursor.execute(sql, website_ids)
+        return {row['website_id']: row for row in cursor.fetchall()}
+
+
+def get_property_details_values(result):
+    """ take the scraping result for a single ad (AdRecord, its values already have the column types),
+    return dictionary {column: value} with the property_details columns, in PROPERTY_DETAILS_COLUMNS order """
+    values = {'address': result.address,
+              'neighborhood': result.neighborhood,
+              'rooms': result.rooms,
+              'size_m2': result.size_m2,
+              'floor_property': result.floor_property,
+              'floors_in_building': result.floors_total,
+              'description': result.description,
+              'entry_date': result.entry_date,
+              'condo_fee': result.condo_fee,
+              'arnona': result.arnona}
+    # boolean features: columns safe_room to sun_boiler, in config.BOOLEAN_FEATURES order
+    values.update(zip(PROPERTY_DETAILS_COLUMNS[10:], result.feature_values()))
+
+    return values
+
+
+def insert_properties(data, connection):
+    """ take list of (website_id, property_type_id, ad_type_id, city_id, contact_id, listing_hash) tuples,
+    insert records to properties table with a multi-row statement.
+    Another worker (--worker) may have inserted the same ad in the meantime: the existing record is kept
+    (unique key on website_id, see migratedb.py), so ids must be read back with get_properties_by_website_id(). """
+    with connection.cursor() as cursor:
+        sql = 'INSERT INTO properties ' \
+              '(website_id, property_type_id, ad_type_id, city_id, contact_id, listing_hash) ' \
+              'VALUES (%s, %s, %s, %s, %s, %s) ' \
+              'ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id);'
+        cursor.executemany(sql, data)
+
+
+def insert_many_property_details(data, connection):
+    """ take list of (property_id, *values in PROPERTY_DETAILS_COLUMNS order) tuples,
+    insert records to property_details table with a multi-row statement.
+    If another worker (--worker) inserted the details of the same property in the meantime, they are overwritten,
+    as an update of an ad already in the database would do. """
+    update_columns('property_details', 'property_id', PROPERTY_DETAILS_COLUMNS, data, connection)
+
+
+def insert_prices(data, connection):
+    """ take list of (property_id, date, price) tuples, insert records to prices table with a multi-row statement """
+    with connection.cursor() as cursor:
+        sql = 'INSERT INTO prices ' \
+              '(property_id, date, price) ' \
+              'VALUES (%s, %s, %s);'
+        cursor.executemany(sql, data)
+
+
+def insert_latest_prices(property_ids, date, connection):
     """
-    insert a new ad into the database,
-    checking foreign ads in auxiliary tables,
-    inserting records to the relevant tables.
-    :param ad_id: ad id in website
-    :param result: dictionary with the scraping result for a single ad
-    :param connection: connection object
-    :param t: transaction count
-    :return: updated transaction count
+    take list of property ids, and for each one copy its latest price to a new prices record of the given date,
+    with a single statement. Used for ads that did not change since the last crawl (see --incremental).
+    Properties without prices are skipped, and so are properties that already have a price of that date:
+    writing the same ads again (a work queue unit crawled twice, a batch retried) adds no records.
     """
-    # deal with foreign keys before inserting main record.
-    contact_id, t = get_contact_id_foreign_key(result, connection, t)
-
-    # if new city, populate cities table with Hebrew name (site does not have English names)
-    city_id, t = get_city_id_foreign_key(result, connection, t)
-
-    website_id = int(ad_id)
-
-    property_type_id = query_db(f'SELECT id FROM property_types WHERE website_id = '
-                                f'{result["property_type"]}', connection)[0]['id']
-    ad_type_id = query_db(f'SELECT id FROM ad_types WHERE website_id = {result["ad_type"]}', connection)[0]['id']
-
-    # now that we have all foreign keys, insert property record to properties table
-    insert_property((website_id, property_type_id, ad_type_id, city_id, contact_id), connection)
-    t += 1
-
-    # property details. Deal with foreign keys and aux tables in the order displayed in the ERD.
-    # get property_id
-    property_id = query_db(f'SELECT id FROM properties WHERE website_id = {website_id}', connection)[0]['id']
-    # arnona and condo_fee are integers, so preprocess.
-    arnona = int(result['arnona']) if result['arnona'] else None
-    condo_fee = int(result['condo_fee']) if result['condo_fee'] else None
-    # get list with all details in order.
-    data = [property_id,
-            result['address'],
-            result['neighborhood'],
-            float(result['rooms']),
-            int(result['size_m2']),
-            result['floor_property'],
-            result['floors_total'],
-            result['description'][:1000],
-            result['entry_date'],
-            condo_fee,
-            arnona,
-            result['mamad'],
-            result['mirpeset'],
-            result['mahsan'],
-            result['soragim'],
-            result['mizug'],
-            result['riut'],
-            result['gisha'],
-            result['maalit'],
-            result['hania'],
-            result['shutafim'],
-            result['pets'],
-            result['boiler']
-            ]
-    # insert property details record.
-    insert_property_details(data, connection)
-    t += 1
-
-    # insert dated price record in separate table
-    data = [property_id, result['date'], result['price']]
-    insert_price(data, connection)
-    t += 1
+    if not property_ids:
+        return
+    with connection.cursor() as cursor:
+        sql = 'INSERT INTO prices (property_id, date, price) ' \
+              'SELECT p.property_id, %s, p.price FROM prices p ' \
+              'JOIN (SELECT MAX(id) AS id FROM prices ' \
+              f'WHERE property_id IN ({", ".join(["%s"] * len(property_ids))}) GROUP BY property_id ' \
+              'HAVING MAX(date) < %s) latest ' \
+              'ON latest.id = p.id;'
+        cursor.execute(sql, [date, *property_ids, date])
 
-    return t
+
+def update_columns(table, key, columns, data, connection):
+    """
+    update the given columns of records already in table, with a single multi-row statement.
+    Written as INSERT ... ON DUPLICATE KEY UPDATE on the primary key: a plain UPDATE
+    takes one statement (and one round trip) per record.
+    :param table: table name
+    :param key: primary key column
+    :param columns: list of columns to update
+    :param data: list of (key value, *column values) tuples. Records not in the table yet are inserted.
+    :param connection: connection instance
+    """
+    with connection.cursor() as cursor:
+        sql = ''.join([f'INSERT INTO {table} ({key}, {", ".join(columns)}) ',
+                       f'VALUES ({", ".join(["%s"] * (len(columns) + 1))}) ',
+                       'ON DUPLICATE KEY UPDATE ',
+                       ', '.join([f'{column} = VALUES({column})' for column in columns]), ';'])
+        cursor.executemany(sql, data)
 
 
-def update_current_add(website_id, result, connection, t):
+def diff_record(key_value, prev_record, new_values, updates):
     """
-    for ad that is already in database, check previous record,
-    and update only new info.
-    :param website_id: ad id in website
-    :param result: dictionary with the scraping result for a single ad
-    :param connection: connection object
-    :param t: transaction count
-    :return: updated transaction count
+    compare new values with the previous record
+    and add the record to updates, grouped by the set of changed columns.
+    :param key_value: primary key value of the record
+    :param prev_record: record from the database
+    :param new_values: dictionary {column: new value}
+    :param updates: dictionary {tuple of changed columns: list of (key value, new_values)}
+    :return: True if any column changed
     """
+    changed = tuple(column for column, value in new_values.items() if value != prev_record[column])
+    if changed:
+        updates.setdefault(changed, []).append((key_value, new_values))
+    return bool(changed)
 
-    # table properties
-    # previous record
-    prev_record = query_db(f'SELECT * FROM properties WHERE website_id = {website_id}', connection)[0]
 
-    # new record
-    property_type_id = query_db(f'SELECT id FROM property_types WHERE website_id = '
-                                f'{result["property_type"]}', connection)[0]['id']
-    ad_type_id = query_db(f'SELECT id FROM ad_types WHERE website_id = {result["ad_type"]}', connection)[0]['id']
+def write_updates(table, key, updates, connection):
+    """
+    write the changes found by diff_record(), one statement per set of changed columns.
+    If there are more than config.MAX_UPDATE_GROUPS sets, write the union of the changed columns
+    in a single statement instead (unchanged columns are rewritten with their current value).
+    :param table: table name
+    :param key: primary key column
+    :param updates: dictionary {tuple of changed columns: list of (key value, new_values)}
+    :param connection: connection instance
+    """
+    if len(updates) > config.MAX_UPDATE_GROUPS:
+        columns = tuple(column for column in next(iter(updates.values()))[0][1]
+                        if any(column in changed for changed in updates))
+        updates = {columns: [record for records in updates.values() for record in records]}
+    for columns, records in updates.items():
+        data = [(key_value, *[new_values[column] for column in columns]) for key_value, new_values in records]
+        update_columns(table, key, list(columns), data, connection)
 
-    contact_id, t = get_contact_id_foreign_key(result, connection, t)
 
-    city_id, t = get_city_id_foreign_key(result, connection, t)
+def feed_ads(results, connection):
+    """
+    write a batch of scraped ads to the database with a handful of multi-row statements.
+    The current properties and property_details records of the whole batch are fetched with one joined query
+    and compared with the scraping results in memory. New ads are inserted, and for ads already in the database
+    only changed records are written, with one statement per set of changed columns (see write_updates()).
+    A price record is inserted for every ad.
+    Does not commit.
+    :param results: list of AdRecord with the scraping result for single ads
+    :param connection: connection instance
+    :return: number of records written
+    """
+    prev_records = get_current_ads([result.website_id for result in results], connection)
+
+    # deal with foreign keys in auxiliary tables first, ad by ad.
+    t = 0
+    new_properties = []
+    properties_updates = {}
+    for result in results:
+        website_id = result.website_id
+        contact_id, t = get_contact_id_foreign_key(result, connection, t)
+        city_id, t = get_city_id_foreign_key(result, connection, t)
+        new_values = {'property_type_id': dimension_cache.get_property_type_id(result.property_type, connection),
+                      'ad_type_id': dimension_cache.get_ad_type_id(result.ad_type, connection),
+                      'city_id': city_id,
+                      'contact_id': contact_id,
+                      'listing_hash': result.listing_hash}
+        prev_record = prev_records.get(website_id)
+        if not prev_record:
+            new_properties.append((website_id, *new_values.values()))
+        else:
+            t += diff_record(prev_record['id'], prev_record, new_values, properties_updates)
 
-    new_values = {'property_type_id': property_type_id,
-                  'ad_type_id': ad_type_id,
-                  'city_id': city_id,
-                  'contact_id': contact_id}
+    # table properties
+    if new_properties:
+        insert_properties(new_properties, connection)
+        t += len(new_properties)
+        # auto-increment ids of a multi-row insert are not guaranteed to be consecutive, so get them back.
+        prev_records.update(get_properties_by_website_id([data[0] for data in new_properties], connection))
+    write_updates('properties', 'id', properties_updates, connection)
+
+    # tables property_details and prices
+    new_details = []
+    details_updates = {}
+    prices_data = []
+    for result in results:
+        prev_record = prev_records[result.website_id]
+        new_values = get_property_details_values(result)
+        if prev_record.get('property_id') is None:
+            new_details.append((prev_record['id'], *new_values.values()))
+        else:
+            t += diff_record(prev_record['property_id'], prev_record, new_values, details_updates)
+        # prices are always considered a new record,
+        # even if scraped twice in the same day (could have changed)
+        prices_data.append((prev_record['id'], result.date, result.price))
+    if new_details:
+        insert_many_property_details(new_details, connection)
+        t += len(new_details)
+    write_updates('property_details', 'property_id', details_updates, connection)
+    insert_prices(prices_data, connection)
+    t += len(prices_data)
 
-    updates = {k: v for k, v in new_values.items() if v != prev_record[k]}
+    return t
 
-    if updates:
-        update_property(website_id, updates, connection)
-        t += 1
 
-    # table property_details
-    # previous record
-    property_id = prev_record['id']  # from table properties
-    prev_record = query_db(f'SELECT * FROM property_details WHERE property_id = {property_id}', connection)[0]
-
-    # arnona and condo_fee are integers, so preprocess.
-    arnona = int(result['arnona']) if result['arnona'] else None
-    condo_fee = int(result['condo_fee']) if result['condo_fee'] else None
-
-    new_values = {'address': result['address'],
-                  'neighborhood': result['neighborhood'],
-                  'rooms': float(result['rooms']),
-                  'size_m2': int(result['size_m2']),
-                  'floor_property': result['floor_property'],
-                  'floors_in_building': result['floors_total'],
-                  'description': result['description'][:1000],
-                  'entry_date': result['entry_date'],
-                  'condo_fee': condo_fee,
-                  'arnona': arnona,
-                  'safe_room': result['mamad'],
-                  'balcony': result['mirpeset'],
-                  'storeroom': result['mahsan'],
-                  'security_bars': result['soragim'],
-                  'air_conditioning': result['mizug'],
-                  'furniture': result['riut'],
-                  'accessibility': result['gisha'],
-                  'elevator': result['maalit'],
-                  'parking': result['hania'],
-                  'roommates': result['shutafim'],
-                  'pets': result['pets'],
-                  'sun_boiler': result['boiler']
-                  }
-
-    updates = {k: v for k, v in new_values.items() if v != prev_record[k]}
-
-    if updates:
-        update_property_details(property_id, updates, connection)
-        t += 1
+# columns of demographics (after city_id) and the fields of the API records they come from.
+DEMOGRAPHICS_FIELDS = {'total_pop': 'סהכ',
+                       'age_0_5': 'גיל_0_5',
+                       'age_6_18': 'גיל_6_18',
+                       'age_19_45': 'גיל_19_45',
+                       'age_46_55': 'גיל_46_55',
+                       'age_56_64': 'גיל_56_64',
+                       'age_65_plus': 'גיל_65_פלוס'}
 
-    # prices are always considered a new record,
-    # even if scraped twice in the same day (could have changed)
-    data = [property_id, result['date'], result['price']]
-    insert_price(data, connection)
-    t += 1
 
-    return t
+def normalize_city_name(name):
+    """
+    key of a city name for in-memory lookups. Matches like the case insensitive collation of the cities table did
+    when names were looked up with SQL: surrounding spaces and case are ignored.
+    """
+    return name.strip().casefold()
 
 
-def get_demographics_data(record, connection):
+def get_demographics_rows(records, cities):
     """
-    for a given record from demographics API query,
-    if the city is in DB cities table (city is relevant),
-    get city_id and return data dictionary with data to be inserted/updated into the DB.
-    If API record is of a city/ishuv that is not relevant, return None.
-    :param record: record from demographics API query
-    :param connection: connection instance
-    :return: data dictionary or None
+    take records from demographics API query and keep those of cities in the database, without queries:
+    city names are looked up in memory, with the aliases of config.CITIES_API_KOMO (see normalize_city_name()).
+    :param records: list of records from demographics API query
+    :param cities: dictionary {name_heb: id} of the cities table (see DimensionCache)
+    :return: dictionary {city_id: {column: value}} in the order of DEMOGRAPHICS_FIELDS
     """
-    city_api_name = record['שם_ישוב'].strip()
-    if city_api_name in config.CITIES_API_KOMO:
-        name_heb = config.CITIES_API_KOMO[city_api_name]
-    else:
-        name_heb = city_api_name
-    if '"' in name_heb:
-        q = f"SELECT id FROM cities WHERE name_heb = '{name_heb}' "
-    else:
-        q = f'SELECT id FROM cities WHERE name_heb = "{name_heb}" '
-    if query_db(q, connection):
-        city_id = query_db(q, connection)[0]['id']
-        data = {'city_id': city_id,
-                'total_pop': int(record['סהכ']),
-                'age_0_5': int(record['גיל_0_5']),
-                'age_6_18': int(record['גיל_6_18']),
-                'age_19_45': int(record['גיל_19_45']),
-                'age_46_55': int(record['גיל_46_55']),
-                'age_56_64': int(record['גיל_56_64']),
-                'age_65_plus': int(record['גיל_65_פלוס'])
-                }
-    else:
-        data = None
-
-    return data
-
-
-def update_or_insert_demographics(record, connection, t):
+    city_ids = {normalize_city_name(name): city_id for name, city_id in cities.items()}
+    aliases = {normalize_city_name(api_name): normalize_city_name(name)
+               for api_name, name in config.CITIES_API_KOMO.items()}
+    rows = {}
+    for record in records:
+        city_api_name = normalize_city_name(record['שם_ישוב'])
+        city_id = city_ids.get(aliases.get(city_api_name, city_api_name))
+        if city_id is not None:
+            rows[city_id] = {column: int(record[field]) for column, field in DEMOGRAPHICS_FIELDS.items()}
+
+    return rows
+
+
+def get_demographics_by_city_id(city_ids, connection):
+    """ take list of city ids, return dictionary {city_id: demographics record} for those in the database,
+    with a single query """
+    if not city_ids:
+        return {}
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT * FROM demographics WHERE city_id IN ({", ".join(["%s"] * len(city_ids))})',
+                       city_ids)
+        return {record['city_id']: record for record in cursor.fetchall()}
+
+
+def bulk_upsert_demographics(records, connection):
     """
-    for a given record from API query,
-    if record is of a relevant city (city that appears in DB cities table),
-    insert (or update) data into DB demographics table.
-    :param record: record from API query
+    write a batch of records from demographics API query to the database, set-based:
+    the cities map comes from dimension_cache, the current demographics records of the batch are fetched
+    with one query and compared in memory, and new or changed records are written
+    with a single multi-row INSERT ... ON DUPLICATE KEY UPDATE (see update_columns()).
+    Records of cities that are not in the database are skipped.
+    Does not commit.
+    :param records: list of records from demographics API query
     :param connection: connection instance
-    :param t: transaction count
-    :return: t
+    :return: dictionary with the number of records 'inserted', 'changed' and 'unchanged'.
+             Records of cities that are not in the database are not counted.
     """
-    data = get_demographics_data(record, connection)
-    if data:
-        city_id = data['city_id']
-        # check if there is already record for the city in demographics table
-        if query_db(f'SELECT * FROM demographics WHERE city_id = {city_id}', connection):
-            # check which values changed and update accordingly
-            prev_record = query_db(f'SELECT * FROM demographics WHERE city_id = {city_id}', connection)[0]
-            updates = {k: v for k, v in data.items() if v != prev_record[k]}
-            if updates:
-                update_demographics(city_id, updates, connection)
-                t += 1
+    dimension_cache.load(connection)
+    rows = get_demographics_rows(records, dimension_cache.cities)
+    prev_records = get_demographics_by_city_id(list(rows), connection)
+    counts = {'inserted': 0, 'changed': 0, 'unchanged': 0}
+    data = []
+    for city_id, new_values in rows.items():
+        prev_record = prev_records.get(city_id)
+        if prev_record is None:
+            counts['inserted'] += 1
+        elif any(value != prev_record[column] for column, value in new_values.items()):
+            counts['changed'] += 1
         else:
-            # new record
-            insert_demographics(list(data.values()), connection)
-            t += 1
-    return t
+            counts['unchanged'] += 1
+            continue
+        data.append((city_id, *new_values.values()))
+    if data:
+        update_columns('demographics', 'city_id', list(DEMOGRAPHICS_FIELDS), data, connection)
+
+    return counts
+
+
+def get_demographics_state(connection):
+    """ return dictionary with the number of cities, the last city id and the number of demographics records.
+    If it did not change, writing the same API records again would not change the database. """
+    state = query_db('SELECT COUNT(*) AS cities, MAX(id) AS max_city_id FROM cities', connection)[0]
+    state['demographics'] = query_db('SELECT COUNT(*) AS demographics FROM demographics', connection)[0]['demographics']
+
+    return dict(state)
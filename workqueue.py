@@ -0,0 +1,153 @@
+"""
+module with the shared work queue of Real Estate scraper, for a crawl split between several worker processes.
+A seeder (--seed QUEUE) fetches the quicklink pages and puts one work unit per (property type, ad type, city)
+in a local SQLite file. Workers (--worker QUEUE), on the same machine or on machines that share the file
+(on a filesystem with working file locks), claim units a few at a time and crawl them.
+A claimed unit is leased to its worker until a deadline, which the worker extends while it is alive.
+Units whose lease expired (the worker died or lost the file) can be claimed again by the other workers.
+Each claim and each status change is a short transaction, so workers do not wait for each other.
+This module defines functions to be used by realestatescraper.py, thus there is no main() function.
+"""
+
+import contextlib
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+import gevent
+
+import config
+
+
+logger = logging.getLogger('scraper')
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class WorkQueue:
+    """ city-level work units of a crawl, shared by the worker processes """
+
+    def __init__(self, path, lease=config.WORKER_LEASE):
+        """
+        :param path: path of the SQLite file. Created if missing.
+        :param lease: seconds during which a claimed unit belongs to its worker, unless the lease is renewed.
+        """
+        self.lease = lease
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+        # autocommit mode: transactions are opened explicitly, with BEGIN IMMEDIATE for the claims.
+        self.connection = sqlite3.connect(path, timeout=config.WORKER_LOCK_TIMEOUT, isolation_level=None)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS units ('
+                                'url TEXT PRIMARY KEY, property_type INTEGER, ad_type INTEGER, cityname TEXT, '
+                                'status TEXT, worker TEXT, lease_expires REAL, attempts INTEGER)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS units_status ON units (status, lease_expires)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.held = set()  # urls of the units leased by this worker
+        self.renewer = None
+
+    @property
+    def today(self):
+        """ date of the crawl in iso format, set by the seeder, or None if the queue was not seeded """
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'today'").fetchone()
+        return row[0] if row else None
+
+    def seed(self, units, today):
+        """
+        replace the units of the queue by a new crawl.
+        :param units: list of (url, property_type, ad_type, cityname) of the city pages to crawl
+        :param today: date of the crawl in iso format, used by all workers
+        """
+        with self.transaction():
+            self.connection.execute('DELETE FROM units')
+            self.connection.executemany('INSERT OR IGNORE INTO units VALUES (?, ?, ?, ?, ?, NULL, 0, 0)',
+                                        [(*unit, PENDING) for unit in units])
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('today', ?)", (today,))
+
+    def claim(self, n=config.WORKER_BATCH):
+        """
+        lease up to n units to this worker: pending units first, then units whose lease expired.
+        :return: list of (url, property_type, ad_type, cityname). Empty if there is nothing left to claim.
+        """
+        now = time.time()
+        with self.transaction():
+            units = self.connection.execute(
+                'SELECT url, property_type, ad_type, cityname, status FROM units '
+                'WHERE status = ? OR (status = ? AND lease_expires < ?) ORDER BY status DESC, rowid LIMIT ?',
+                (PENDING, LEASED, now, n)).fetchall()
+            self.connection.executemany('UPDATE units SET status = ?, worker = ?, lease_expires = ?, '
+                                        'attempts = attempts + 1 WHERE url = ?',
+                                        [(LEASED, self.worker, now + self.lease, unit[0]) for unit in units])
+        for url, _, _, _, status in units:
+            if status == LEASED:
+                logger.info(f'Work queue: reclaimed expired unit {url}')
+        self.held.update(unit[0] for unit in units)
+
+        return [unit[:4] for unit in units]
+
+    def complete(self, urls):
+        """ record units as done. Units whose lease expired and were claimed by another worker are left to it. """
+        with self.transaction():
+            self.connection.executemany('UPDATE units SET status = ?, lease_expires = 0 WHERE url = ? AND worker = ?',
+                                        [(DONE, url, self.worker) for url in urls])
+        self.held.difference_update(urls)
+
+    def release(self, urls):
+        """
+        give units back to the queue after a failure, to be claimed again, by any worker.
+        Units that were already tried config.WORKER_MAX_ATTEMPTS times are recorded as failed.
+        As in complete(), units claimed by another worker in the meantime are left to it.
+        """
+        with self.transaction():
+            self.connection.executemany('UPDATE units SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, '
+                                        'worker = NULL, lease_expires = 0 WHERE url = ? AND worker = ?',
+                                        [(config.WORKER_MAX_ATTEMPTS, FAILED, PENDING, url, self.worker)
+                                         for url in urls])
+        self.held.difference_update(urls)
+
+    def renew(self):
+        """ extend the lease of the units held by this worker (only the ones still leased to it) """
+        if not self.held:
+            return
+        with self.transaction():
+            self.connection.executemany('UPDATE units SET lease_expires = ? WHERE url = ? AND worker = ? '
+                                        'AND status = ?',
+                                        [(time.time() + self.lease, url, self.worker, LEASED) for url in self.held])
+
+    def counts(self):
+        """ return dictionary {status: number of units} """
+        return dict(self.connection.execute('SELECT status, COUNT(*) FROM units GROUP BY status'))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ context manager: a write transaction, which takes the file lock right away """
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        self.connection.execute('COMMIT')
+
+    def run_renewals(self):
+        """ background greenlet: renew the leases three times per lease period """
+        while True:
+            gevent.sleep(self.lease / 3)
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                logger.error(f'Work queue: {repr(e)}')
+
+    def start(self):
+        """ start renewing the leases in the background """
+        self.renewer = gevent.spawn(self.run_renewals)
+
+    def close(self):
+        """ stop renewing the leases and close the file. Units still held expire and are reclaimed. """
+        if self.renewer:
+            self.renewer.kill()
+        self.connection.close()
+